@@ -0,0 +1,86 @@
+# Answer extraction micro-benchmark.
+#
+# Times falcon.answers.extract_answers against the extractor it replaced
+# (first "}" after the last "boxed{") on synthetic solutions of realistic
+# length, and counts the solutions on which the two disagree.
+#
+#   python benchmarks/extract_answers.py [--solutions 20000] [--length 4000] [--runs 5]
+#
+# Exits with status 1 when the new extractor takes longer than --max-slowdown
+# (default 1.0) times the old one's time.
+import os
+import sys
+import random
+import argparse
+import statistics
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from falcon.answers import extract_answers
+
+ANSWERS = ["42", "\\frac{1}{2}", "x^{2} + 1", "\\sqrt{3}", "\\{1, 2\\}", "-7", "\\text{(B)}", "2\\pi"]
+FILLER = "We expand the expression and simplify each term, using $a^{2} + b^{2} = c^{2}$ where needed. "
+
+
+def legacy_extract_answers(solutions):
+    answers = []
+    for solution in solutions:
+        ind_start = solution.rfind("boxed{") + len("boxed{")
+        ind_end = solution.find("}", ind_start)
+        if ind_start == -1 or ind_end == -1:
+            answers.append(None)
+        else:
+            answers.append(solution[ind_start:ind_end:])
+    return answers
+
+
+def make_solutions(count, length, seed=0):
+    rng = random.Random(seed)
+    body = FILLER * (length // len(FILLER) + 1)
+    solutions = []
+    for _ in range(count):
+        answer = rng.choice(ANSWERS)
+        text = body[:rng.randint(length // 2, length)]
+        kind = rng.random()
+        if kind < 0.8:
+            solutions.append(f"{text}\nTherefore the answer is $\\boxed{{{answer}}}$.")
+        elif kind < 0.9:
+            solutions.append(f"{text}\nFinal answer: {answer}")
+        else:
+            # Cut off before the answer
+            solutions.append(text)
+    return solutions
+
+
+def measure(function, solutions, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(solutions)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--solutions", type=int, default=20000)
+    parser.add_argument("--length", type=int, default=4000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-slowdown", type=float, default=1.0)
+    args = parser.parse_args()
+
+    solutions = make_solutions(args.solutions, args.length)
+    legacy = measure(legacy_extract_answers, solutions, args.runs)
+    current = measure(extract_answers, solutions, args.runs)
+    differ = sum(1 for old, new in zip(legacy_extract_answers(solutions), extract_answers(solutions)) if old != new)
+
+    for name, seconds in [("legacy", legacy), ("falcon.answers", current)]:
+        print(f"{name:<16} {seconds * 1000:8.1f} ms   {args.solutions / seconds:12.0f} solutions/s")
+    print(f"{'differ':<16} {differ:8d} of {args.solutions}")
+    sys.exit(1 if current > legacy * args.max_slowdown else 0)
+
+
+if __name__ == "__main__":
+    main()
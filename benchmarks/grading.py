@@ -0,0 +1,46 @@
+# Grading micro-benchmark.
+#
+# Builds a CorrectnessMatrix for synthetic answers and times the pass@k and
+# maj@k sweeps over k = 1..samples and a full evaluate() with bootstrap
+# confidence intervals. Needs numpy.
+#
+#   python benchmarks/grading.py [--problems 10000] [--samples 64] [--resamples 1000]
+import os
+import sys
+import argparse
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy
+from falcon.evaluation import CorrectnessMatrix, evaluate
+
+
+def timed(name, function):
+    start = time.perf_counter()
+    result = function()
+    print(f"{name:<24} {(time.perf_counter() - start) * 1000:10.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--problems", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=64)
+    parser.add_argument("--resamples", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    answers = [[str(answer) for answer in rng.integers(0, 4, args.samples)] for _ in range(args.problems)]
+    truth = [str(answer) for answer in rng.integers(0, 4, args.problems)]
+    ks = list(range(1, args.samples + 1))
+
+    matrix = timed("correctness matrix", lambda: CorrectnessMatrix(answers, truth))
+    timed("pass@k sweep", lambda: matrix.pass_at_k(ks))
+    timed("maj@k sweep", lambda: matrix.maj_at_k(ks))
+    timed("evaluate with CIs", lambda: evaluate(matrix, ks=ks, resamples=args.resamples, seed=0))
+
+
+if __name__ == "__main__":
+    main()
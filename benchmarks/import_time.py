@@ -0,0 +1,79 @@
+# Import-time regression benchmark.
+#
+# Measures `import falcon` (and constructing a Challenger) in fresh
+# interpreters and checks that none of the heavy dependencies (SDKs,
+# datasets, numpy, ...) is imported before it is actually used.
+#
+#   python benchmarks/import_time.py [--runs 10] [--budget-ms 50]
+#
+# Exits with status 1 when a median time exceeds the budget or a
+# heavy module is imported eagerly.
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["openai", "together", "httpx", "datasets", "pyarrow", "pandas", "numpy", "sympy"]
+
+# Each case runs in a new interpreter and reports its duration and the heavy
+# modules it loaded
+CASES = {
+    "import falcon": "import falcon",
+    "falcon.Challenger": "import falcon; falcon.Challenger",
+    "Challenger('OpenAI')": "import falcon; falcon.Challenger('OpenAI')",
+    "falcon.Storage": "import falcon; falcon.Storage",
+    "falcon.Grader": "import falcon; falcon.Grader"
+}
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"ms": elapsed * 1000, "loaded": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(code, runs):
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(code=code, heavy=HEAVY_MODULES)],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        loaded.update(result["loaded"])
+    return statistics.median(timings), sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    failed = False
+    for name, code in CASES.items():
+        median, loaded = measure(code, args.runs)
+        status = "ok"
+        if len(loaded) > 0:
+            status = "eager import of " + ", ".join(loaded)
+            failed = True
+        elif median > args.budget_ms:
+            status = f"over budget ({args.budget_ms:.0f} ms)"
+            failed = True
+        print(f"{name:<24} {median:8.1f} ms   {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
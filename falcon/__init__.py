@@ -1,5 +1,35 @@
-from .challenger import Challenger
-from .storage import Storage
-from .grader import Grader
+import importlib
 
-__version__ = "1.1.0"
\ No newline at end of file
+__version__ = "1.1.0"
+
+# Public names and the submodule defining them. Submodules (and the heavy
+# dependencies behind them) are imported on first access, so `import falcon`
+# stays cheap for short-lived workers.
+_EXPORTS = {
+    "Challenger": ".challenger",
+    "Storage": ".storage",
+    "Grader": ".grader",
+    "FailedRequest": ".retry",
+    "RetryPolicy": ".retry",
+    "set_provider_budget": ".budget",
+    "CancelToken": ".cancel",
+    "JobManager": ".jobs",
+    "get_usage": ".usage",
+    "metrics_snapshot": ".metrics",
+    "metrics_json": ".metrics",
+    "metrics_prometheus": ".metrics"
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
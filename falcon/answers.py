@@ -0,0 +1,103 @@
+import re
+
+# Commands whose braced argument is the answer, each with the offset of
+# "box" in it: one rfind("box") finds the last of either
+BOX_MARKERS = (("\\boxed", 1), ("\\fbox", 2))
+FINAL_ANSWER = "final answer"
+
+# What follows "final answer": an optional "is" or colon, then the answer
+# up to the end of its line
+_FINAL_ANSWER = re.compile(r"(?:\s+is)?\s*[:：]?[ \t]*([^\n]*)")
+_FINAL_ANSWER_STRIP = " \t$.*"
+
+# Text without braces, where a backslash escapes the brace after it
+_PLAIN = r"[^{}\\]*(?:\\(?:[{}]|(?![{}]))[^{}\\]*)*"
+
+
+def _nest(inner):
+    return r"[^{}\\]*(?:(?:\\(?:[{}]|(?![{}]))|\{" + inner + r"\})[^{}\\]*)*"
+
+
+# A brace pair holding up to two levels of braces, matched in one C call;
+# deeper answers take the scan in _box_argument
+_BRACED = re.compile(r"\{(" + _nest(_nest(_PLAIN)) + r")\}")
+
+
+# The argument of the last complete \boxed{...} (or \fbox{...}) in the
+# solution, braces balanced, so \boxed{\frac{1}{2}} gives \frac{1}{2}. A box
+# left open (a response cut short) or left empty is skipped for the one
+# before it. Without any box, the text after the last "final answer" (any
+# case, e.g. "Final Answer: 12") is used. Returns None when neither is found.
+# The text is scanned in C only: one rfind for the last box and one match
+# of _BRACED for its argument.
+def extract_answer(solution):
+    if not isinstance(solution, str):
+        return None
+    end = len(solution)
+    while True:
+        found = solution.rfind("box", 0, end)
+        if found == -1:
+            return _final_answer(solution)
+        if found >= 1 and solution.startswith("\\boxed{", found - 1):
+            first = found + 6
+        elif found >= 2 and solution.startswith("\\fbox{", found - 2):
+            first = found + 4
+        else:
+            first = -1
+        answer = None
+        if first != -1:
+            braced = _BRACED.match(solution, first - 1)
+            answer = braced.group(1) if braced != None else _box_argument(solution, first - 1)
+        else:
+            # Not a box, or one with spaces before its brace
+            for marker, offset in BOX_MARKERS:
+                start = found - offset
+                if start >= 0 and solution.startswith(marker, start):
+                    answer = _box_argument(solution, start + len(marker))
+                    break
+        if answer:
+            return answer
+        end = found + 2
+
+
+def extract_answers(solutions):
+    return list(map(extract_answer, solutions))
+
+
+# Text between the brace opening at or after `index` (spaces may come
+# first) and its matching brace; None when there is no such brace pair.
+# Escaped braces (\{ and \}) are part of the answer and not counted.
+def _box_argument(solution, index):
+    while solution.startswith(" ", index):
+        index += 1
+    if not solution.startswith("{", index):
+        return None
+    braced = _BRACED.match(solution, index)
+    if braced != None:
+        return braced.group(1)
+    first = index + 1
+    depth = 1
+    position = first
+    while True:
+        close = solution.find("}", position)
+        if close == -1:
+            return None
+        opening = solution.find("{", position, close)
+        brace = close if opening == -1 else opening
+        position = brace + 1
+        if solution[brace - 1] == "\\":
+            continue
+        if brace == opening:
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            return solution[first:close]
+
+
+def _final_answer(solution):
+    found = solution.lower().rfind(FINAL_ANSWER)
+    if found == -1:
+        return None
+    answer = _FINAL_ANSWER.match(solution, found + len(FINAL_ANSWER)).group(1).strip(_FINAL_ANSWER_STRIP)
+    return answer if answer != "" else None
@@ -0,0 +1,209 @@
+import time
+import asyncio
+import inspect
+from .ratelimit import request_cost
+from .retry import FailedRequest, classify, RATE_LIMIT, REASON_DEADLINE
+from .budget import DEF_PRIORITY
+from .scheduler import Scheduler, _InFlight, _RetryState, _copy_result, _merge_fan_out
+
+# Kept apart from scheduler.py so that sync-only users never import asyncio
+
+class AsyncScheduler(Scheduler):
+    # Same contract as Scheduler, but every in-flight request is a task on a
+    # single event loop instead of a parked thread. Coroutine functions (the
+    # pipes' aretrieve_response) are awaited directly; plain functions are
+    # pushed to the loop's default executor so sync-only pipes still work.
+    def __init__(self, function, concurrent_requests=64, max_retries=8, delay=0.1, rate_limiter=None, retry_policy=None, circuit_breaker=None, fan_out=False, max_choices=None, cache=None, cache_namespace=None, coalesce=True, collapse_voters=False, journal=None, executor=None, budget=None, priority=DEF_PRIORITY, hedge=None, fallback=None, fallback_kwargs=None, cancel=None, metrics=None):
+        super().__init__(
+            function,
+            concurrent_requests=concurrent_requests,
+            max_retries=max_retries,
+            delay=delay,
+            rate_limiter=rate_limiter,
+            retry_policy=retry_policy,
+            circuit_breaker=circuit_breaker,
+            fan_out=fan_out,
+            max_choices=max_choices,
+            cache=cache,
+            cache_namespace=cache_namespace,
+            coalesce=coalesce,
+            collapse_voters=collapse_voters,
+            journal=journal,
+            executor=executor,
+            budget=budget,
+            priority=priority,
+            hedge=hedge,
+            fallback=fallback,
+            fallback_kwargs=fallback_kwargs,
+            cancel=cancel,
+            metrics=metrics
+        )
+        self.is_coroutine = inspect.iscoroutinefunction(function)
+
+    async def run(self, prompts, **kwargs):
+        output = [None] * len(prompts)
+        distinct, positions = self._distinct(prompts)
+        async for idx, result in self.run_iter(distinct, **kwargs):
+            for i in positions[idx]:
+                output[i] = _copy_result(result)
+        return self.mark_unfinished(output)
+
+    async def run_iter(self, prompts, window=None, first_voter=0, **kwargs):
+        count = kwargs.get("response_count") or 1
+        if self._collapses(count, kwargs):
+            kwargs["response_count"] = 1
+            async for idx, res in self.run_iter(prompts, window, first_voter=first_voter, **kwargs):
+                yield idx, res if isinstance(res, FailedRequest) else res * count
+            return
+        if not self.fan_out or count == 1:
+            tasks = ((prompt, list(range(first_voter, first_voter + count))) for prompt in prompts)
+            async for entry in self._run_iter(tasks, window, **kwargs):
+                yield entry
+            return
+        tasks = ((prompt, [first_voter + voter]) for prompt in prompts for voter in range(count))
+        partial = {}
+        async for j, res in self._run_iter(tasks, window, **kwargs):
+            idx = j // count
+            partial.setdefault(idx, []).append((j, res))
+            if len(partial[idx]) == count:
+                yield idx, _merge_fan_out(partial.pop(idx))
+        for idx in list(partial):
+            yield idx, _merge_fan_out(partial.pop(idx))
+
+    async def _run_iter(self, tasks, window, **kwargs):
+        window = window if window != None else 2 * self.concurrent_requests
+        semaphore = asyncio.Semaphore(self.concurrent_requests)
+        tasks = enumerate(tasks)
+        exhausted = False
+
+        async def worker(prompt, voters):
+            async with semaphore:
+                return await self.run_task(prompt, voters, **kwargs)
+
+        in_flight = _InFlight(self.coalesce)
+        try:
+            while True:
+                while not exhausted and in_flight.waiting < window and self.stop_reason() == None:
+                    entry = next(tasks, None)
+                    if entry == None:
+                        exhausted = True
+                        break
+                    i, (prompt, voters) = entry
+                    if not in_flight.attach(i, prompt, voters):
+                        in_flight.add(asyncio.ensure_future(worker(prompt, voters)), i, prompt, voters)
+                if in_flight.waiting == 0:
+                    return
+                done, _ = await asyncio.wait(in_flight.handles(), timeout=self._remaining(), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    for i in in_flight.complete(task):
+                        yield i, _copy_result(result)
+                if self._expired():
+                    for task in in_flight.handles():
+                        task.cancel()
+                        for i in in_flight.complete(task):
+                            yield i, FailedRequest(REASON_DEADLINE)
+                    return
+        finally:
+            for task in in_flight.handles():
+                task.cancel()
+
+    async def run_task(self, prompt, voters, **kwargs):
+        cached = self._cache_lookup(prompt, voters, kwargs)
+        missing = [voter for voter in voters if voter not in cached]
+        if len(missing) == 0:
+            return [cached[voter] for voter in voters]
+        kwargs["response_count"] = len(missing)
+        res, substituted = await self.run_hedged(prompt, **kwargs)
+        return self._cache_store(prompt, voters, cached, missing, res, kwargs, store=not substituted)
+
+    async def run_hedged(self, prompt, **kwargs):
+        backup = self._backup(kwargs)
+        delay = None if backup == None else self.hedge.delay()
+        start = time.monotonic()
+        primary = asyncio.ensure_future(self.run_with_retries(prompt, **kwargs))
+        if self.hedge != None:
+            primary.add_done_callback(lambda task: self._record_latency(task, start))
+        second = None
+        try:
+            if delay == None:
+                return await primary, False
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if len(done) > 0 or not self.hedge.allow():
+                return await primary, False
+            fallback, fallback_kwargs, substituted = backup
+            second = asyncio.ensure_future(fallback.run_with_retries(prompt, **fallback_kwargs))
+            pending = {primary, second}
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    res = task.result()
+                    if isinstance(res, FailedRequest):
+                        continue
+                    if task is second:
+                        self.hedge.record_win()
+                        return res, substituted
+                    return res, False
+            return primary.result(), False
+        finally:
+            # The losing call (or both, if this task was cancelled) is cancelled
+            for task in [primary, second]:
+                if task != None and not task.done():
+                    task.cancel()
+
+    async def call(self, prompt, **kwargs):
+        if self.is_coroutine:
+            return await self.function(prompt, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: self.function(prompt, **kwargs))
+
+    async def run_with_retries(self, prompt, **kwargs):
+        state = _RetryState()
+        while True:
+            if self.stop_reason() != None:
+                return self._record_failure(FailedRequest(self.stop_reason(), state.error, state.attempts))
+            if not self._circuit_allows():
+                backoff, failure = self._after_circuit_open(state)
+            else:
+                kind = None
+                slot = False
+                entered = False
+                started = None
+                queued = time.monotonic()
+                try:
+                    # The provider budget is queued for first so that its
+                    # priority order is not bypassed by the rate limiter
+                    if self.budget != None:
+                        if not await self.budget.aacquire(self.run_id, self.priority, self.cancel):
+                            # Stopped while queued: the check above returns
+                            continue
+                        slot = True
+                    if self.rate_limiter != None:
+                        await self.rate_limiter.aacquire(*request_cost(prompt, self.max_choices, **kwargs))
+                        entered = True
+                    started = self._record_start(queued)
+                    # asyncio-level guard in case the SDK does not enforce the timeout
+                    output = await asyncio.wait_for(self.call(prompt, **kwargs), kwargs.get("timeout"))
+                    started = self._record_end(started)
+                    self._after_success()
+                    await asyncio.sleep(self.delay)
+                    return output
+                except Exception as e:
+                    kind = classify(e)
+                    started = self._record_end(started, kind)
+                    backoff, failure = self._after_error(e, kind, state)
+                finally:
+                    # A call interrupted by cancellation (a losing hedge)
+                    self._record_end(started, "cancelled")
+                    if entered:
+                        self.rate_limiter.release(kind == RATE_LIMIT)
+                    if slot:
+                        self.budget.release(self.run_id)
+            if failure != None:
+                return self._record_failure(failure)
+            if self.metrics != None:
+                self.metrics.record_retry()
+            if self.cancel != None:
+                await self.cancel.async_wait(backoff)
+            else:
+                await asyncio.sleep(backoff)
@@ -0,0 +1,126 @@
+import itertools
+import threading
+
+# Priority classes: lower values are served first
+PRIORITIES = {
+    "interactive": 0,
+    "normal": 1,
+    "bulk": 2
+}
+DEF_PRIORITY = "normal"
+# How often an async waiter (or one with a cancel token) re-checks for a
+# free slot
+POLL_INTERVAL = 0.02
+
+_BUDGETS = {}
+_BUDGETS_LOCK = threading.Lock()
+_RUN_IDS = itertools.count()
+_TICKETS = itertools.count()
+
+
+def new_run_id():
+    return next(_RUN_IDS)
+
+
+class ProviderBudget:
+    # Process-wide cap on in-flight requests to one provider, shared by every
+    # Scheduler. A free slot goes to the waiting request with the best
+    # (priority, slots already held by its run, arrival) ordering, so
+    # interactive calls jump the queue and concurrent runs of the same
+    # priority converge to an equal share.
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.condition = threading.Condition()
+        self.in_use = 0
+        self.held = {}
+        self.waiting = {}
+
+    def _best(self):
+        return min(self.waiting, key=lambda ticket: (self.waiting[ticket][0], self.held.get(self.waiting[ticket][1], 0), ticket))
+
+    def _try_grant(self, ticket):
+        if self.in_use >= self.max_concurrency or self._best() != ticket:
+            return False
+        run = self.waiting.pop(ticket)[1]
+        self.in_use += 1
+        self.held[run] = self.held.get(run, 0) + 1
+        return True
+
+    # Both return True once a slot is held, or False (leaving the queue)
+    # when `cancel`, a CancelToken, stops first
+    def acquire(self, run, priority=DEF_PRIORITY, cancel=None):
+        ticket = next(_TICKETS)
+        with self.condition:
+            self.waiting[ticket] = (PRIORITIES[priority], run)
+            try:
+                while not self._try_grant(ticket):
+                    if cancel != None and cancel.stopped():
+                        self._leave(ticket)
+                        return False
+                    self.condition.wait(None if cancel == None else POLL_INTERVAL)
+            except BaseException:
+                self._leave(ticket)
+                raise
+        return True
+
+    async def aacquire(self, run, priority=DEF_PRIORITY, cancel=None):
+        import asyncio
+        ticket = next(_TICKETS)
+        with self.condition:
+            self.waiting[ticket] = (PRIORITIES[priority], run)
+        try:
+            while True:
+                with self.condition:
+                    if self._try_grant(ticket):
+                        return True
+                    if cancel != None and cancel.stopped():
+                        self._leave(ticket)
+                        return False
+                await asyncio.sleep(POLL_INTERVAL)
+        except BaseException:
+            with self.condition:
+                self._leave(ticket)
+            raise
+
+    # Called with the condition held
+    def _leave(self, ticket):
+        self.waiting.pop(ticket, None)
+        self.condition.notify_all()
+
+    def release(self, run):
+        with self.condition:
+            self.in_use -= 1
+            self.held[run] -= 1
+            if self.held[run] == 0:
+                del self.held[run]
+            self.condition.notify_all()
+
+    def resize(self, max_concurrency):
+        with self.condition:
+            self.max_concurrency = max_concurrency
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_use": self.in_use,
+                "waiting": len(self.waiting),
+                "runs": dict(self.held)
+            }
+
+
+def set_provider_budget(pipename, max_concurrency):
+    # max_concurrency=None removes the budget
+    with _BUDGETS_LOCK:
+        if max_concurrency == None:
+            _BUDGETS.pop(pipename, None)
+        elif pipename in _BUDGETS:
+            _BUDGETS[pipename].resize(max_concurrency)
+        else:
+            _BUDGETS[pipename] = ProviderBudget(max_concurrency)
+
+
+def get_provider_budget(pipename):
+    with _BUDGETS_LOCK:
+        return _BUDGETS.get(pipename)
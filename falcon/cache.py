@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import threading
+
+DEF_CACHE_PATH = os.path.join(".falcon_cache", "responses.sqlite")
+# Eviction runs once every this many writes (and when the cache is opened)
+EVICT_EVERY = 1000
+
+# Request parameters that change the response and so belong in the key
+_KEY_PARAMS = ["model", "temperature", "max_tokens", "system_prompt"]
+
+
+class ResponseCache:
+    # Content-addressed store of single responses, keyed by
+    # (pipe, model, temperature, max_tokens, system prompt, prompt, voter index).
+    # Entries older than max_age seconds are dropped, and the least recently
+    # used ones are dropped once the stored text exceeds max_size bytes.
+    def __init__(self, path=DEF_CACHE_PATH, max_size=None, max_age=None, refresh=False):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        # When True, cached entries are ignored (but new responses are stored)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.writes = 0
+
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        # Imported here, like hashlib in key(): both are slow to import and
+        # only needed once a cache is used
+        import sqlite3
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self.connection.commit()
+        self.evict()
+
+    @staticmethod
+    def key(namespace, prompt, voter, params):
+        import hashlib
+        material = [namespace, prompt, voter] + [params.get(name) for name in _KEY_PARAMS]
+        # Responses cut short after their answer are kept apart from full ones
+        if params.get("stop_on_answer"):
+            material.append("stop_on_answer")
+        return hashlib.sha256(json.dumps(material).encode("utf-8")).hexdigest()
+
+    # Returns {voter index: response} for the voters found in the cache
+    def get_many(self, namespace, prompt, voters, params):
+        if self.refresh:
+            with self.lock:
+                self.misses += len(voters)
+            return {}
+        keys = {self.key(namespace, prompt, voter, params): voter for voter in voters}
+        now = time.time()
+        found = {}
+        with self.lock:
+            placeholders = ",".join("?" * len(keys))
+            rows = self.connection.execute(
+                f"SELECT key, response, created FROM responses WHERE key IN ({placeholders})",
+                list(keys)
+            ).fetchall()
+            for key, response, created in rows:
+                if self.max_age == None or now - created <= self.max_age:
+                    found[keys[key]] = response
+            if len(found) > 0:
+                self.connection.execute(
+                    f"UPDATE responses SET accessed = ? WHERE key IN ({placeholders})",
+                    [now] + list(keys)
+                )
+                self.connection.commit()
+            self.hits += len(found)
+            self.misses += len(voters) - len(found)
+        return found
+
+    def put_many(self, namespace, prompt, responses, params):
+        # responses: {voter index: response}
+        now = time.time()
+        rows = []
+        for voter, response in responses.items():
+            if not isinstance(response, str):
+                continue
+            rows.append((self.key(namespace, prompt, voter, params), response, len(response.encode("utf-8")), now, now))
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+            self.writes += len(rows)
+            evict = self.writes >= EVICT_EVERY
+            if evict:
+                self.writes = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            if self.max_age != None:
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_size != None:
+                total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_size:
+                    stale = []
+                    for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed ASC"):
+                        stale.append((key,))
+                        total -= size
+                        if total <= self.max_size:
+                            break
+                    self.connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM responses")
+            self.connection.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "entries": entries, "size": size}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
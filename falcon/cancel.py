@@ -0,0 +1,55 @@
+import time
+import threading
+
+# How often a waiting retry re-checks a parent token
+POLL_INTERVAL = 0.05
+
+
+class CancelToken:
+    # Cooperative stop signal for a run. Once cancel() is called (or the
+    # deadline, in seconds from creation, has passed) schedulers submit no new
+    # requests and stop retrying; requests already sent are drained. A token
+    # created with a parent also stops when the parent does.
+    def __init__(self, deadline=None, parent=None):
+        self.event = threading.Event()
+        self.expires = None if deadline == None else time.monotonic() + deadline
+        self.parent = parent
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        return self.event.is_set() or (self.parent != None and self.parent.cancelled())
+
+    def expired(self):
+        if self.expires != None and time.monotonic() >= self.expires:
+            return True
+        return self.parent != None and self.parent.expired()
+
+    def stopped(self):
+        return self.cancelled() or self.expired()
+
+    # Seconds left before the deadline, or None without one
+    def remaining(self):
+        remaining = None if self.expires == None else max(0, self.expires - time.monotonic())
+        if self.parent != None and self.parent.remaining() != None:
+            remaining = self.parent.remaining() if remaining == None else min(remaining, self.parent.remaining())
+        return remaining
+
+    # Sleeps up to `seconds`, waking up early when the token stops
+    def wait(self, seconds):
+        end = time.monotonic() + seconds
+        while not self.stopped():
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            self.event.wait(min(left, POLL_INTERVAL) if self.parent != None or self.expires != None else left)
+
+    async def async_wait(self, seconds):
+        import asyncio
+        end = time.monotonic() + seconds
+        while not self.stopped():
+            left = end - time.monotonic()
+            if left <= 0:
+                return
+            await asyncio.sleep(min(left, POLL_INTERVAL))
@@ -1,9 +1,22 @@
+import math
+import time
 from .pipelines import Pipeline
-from .scheduler import Scheduler
+from .pipelines.streaming import DEF_ANSWER_GRACE
+from .ratelimit import RateLimiter, get_rate_budget
+from .cache import DEF_CACHE_PATH
+from .budget import PRIORITIES, DEF_PRIORITY, get_provider_budget
+from .cancel import CancelToken
+from .usage import get_usage
+from .answers import extract_answers
+from .equivalence import canonicalize
+from .routing import RoutedRun, plan_route, MIN_BATCH_REQUESTS, BATCH_SHARE, POLL_INTERVAL
 
 DEFAULT_TEMPLATE = "Please solve the following problem: {statement};"
 DEFAULT_HINT_TEMPLATE = "Please solve the following problem: {statement}; Here is a hint that might help: {hint};"
 
+# Fewest votes a leader needs before the confidence rule may stop voting
+MIN_CONFIDENCE_VOTES = 3
+
 class Challenger:
     def __init__(self, pipename='OpenAI', model=None, template=None, temperature=None, max_tokens=None):
         self.set_pipe(pipename)
@@ -11,9 +24,30 @@ class Challenger:
         self.set_model(model)
         self.set_temperature(temperature)
         self.set_max_tokens(max_tokens)
-        self.concurrent_requests = 1
-        self.max_retries = 1
+        self.system_prompt = None
+        self.concurrent_requests = 8
+        self.max_retries = 8
         self.delay = 0.1
+        self.timeout = None
+        self.stop_on_answer = False
+        self.answer_grace = DEF_ANSWER_GRACE
+        # Budgets chosen with set_rate_limits (shared by the pipe model; those
+        # never set are left to other Challengers) and this Challenger's own
+        # adaptive concurrency limiter, kept between runs
+        self.budget_settings = {}
+        self.adaptive_concurrency = True
+        self.rate_limiter = None
+        self.retry_policy = None
+        self.cache = None
+        self.collapse_voters = False
+        self.keepalive_expiry = 30
+        self.http2 = False
+        self.executor = None
+        self.client_config = None
+        self.priority = DEF_PRIORITY
+        self.hedge = None
+        self.fallback_pipe = None
+        self.fallback_model = None
         self.gpus = False
 
     def gpu_setup(self, gpu_type, gpu_count):
@@ -25,6 +59,7 @@ class Challenger:
         if pipename in Pipeline.get_pipes():
             self.pipeline = Pipeline(pipename)
             self.pipename = pipename
+            self.client_config = None
         else:
             raise Exception("Invalid pipe name - '" + pipe_name + "'")
 
@@ -43,6 +78,110 @@ class Challenger:
     def set_max_tokens(self, max_tokens):
         self.max_tokens = max_tokens
 
+    # Sent ahead of every prompt, sync or batch, so it is part of the prefix
+    # the provider caches (None sends no system message)
+    def set_system_prompt(self, system_prompt):
+        self.system_prompt = system_prompt
+
+    def set_concurrency(self, concurrent_requests, max_retries=None, delay=None):
+        self.concurrent_requests = concurrent_requests
+        if max_retries != None:
+            self.max_retries = max_retries
+        if delay != None:
+            self.delay = delay
+
+    # Seconds before a single request is abandoned (and retried); passed to the pipe's SDK
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+
+    # With output_type='answers' only the \boxed{} answer of a response is
+    # used: pipes that support it then stream the responses and end each one
+    # `grace` characters after its answer box has closed, saving the tokens
+    # (and time) of the recap models write after it
+    def set_stop_on_answer(self, stop_on_answer=True, grace=DEF_ANSWER_GRACE):
+        self.stop_on_answer = stop_on_answer
+        self.answer_grace = grace
+
+    # HTTP options of the pipe's client; its pool is sized to concurrent_requests
+    def set_connection_options(self, keepalive_expiry=30, http2=False):
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+
+    # The worker threads and the pipe's HTTP client are kept between calls;
+    # close() (or leaving a `with Challenger(...)` block) releases them
+    def close(self):
+        if self.executor != None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Budgets are shared by every Challenger using the same pipe and model.
+    # With adaptive=True the number of this Challenger's in-flight requests
+    # backs off on rate limit errors and grows back (up to
+    # concurrent_requests) on success.
+    def set_rate_limits(self, requests_per_minute=None, tokens_per_minute=None, adaptive=True):
+        self.budget_settings["requests_per_minute"] = requests_per_minute
+        self.budget_settings["tokens_per_minute"] = tokens_per_minute
+        self.adaptive_concurrency = adaptive
+
+    # Priority class ('interactive', 'normal' or 'bulk') of this Challenger's
+    # requests within the pipe's process-wide budget (see set_provider_budget)
+    def set_priority(self, priority):
+        if priority not in PRIORITIES:
+            raise Exception("Priority must be one of " + ", ".join(PRIORITIES))
+        self.priority = priority
+
+    # Duplicates a call once it runs longer than `percentile` of the observed
+    # latencies, to the same pipe or to fallback_pipe / fallback_model, and
+    # keeps whichever answer comes first (percentile=None disables hedging)
+    def set_hedging(self, percentile=95, fallback_pipe=None, fallback_model=None, max_ratio=0.1, min_samples=20):
+        if fallback_pipe != None and fallback_pipe not in Pipeline.get_pipes():
+            raise Exception("Invalid pipe name - '" + fallback_pipe + "'")
+        from .hedge import HedgePolicy
+        self.hedge = None if percentile == None else HedgePolicy(percentile=percentile, min_samples=min_samples, max_ratio=max_ratio)
+        self.fallback_pipe = fallback_pipe
+        self.fallback_model = fallback_model
+
+    def hedge_stats(self):
+        return None if self.hedge == None else self.hedge.stats()
+
+    # Overrides the default RetryPolicy(max_retries=self.max_retries)
+    def set_retry_policy(self, retry_policy):
+        self.retry_policy = retry_policy
+
+    # Enables the on-disk response cache (path=None disables it). Pass
+    # refresh=True to ignore stored responses while still recording new ones.
+    def set_cache(self, path=DEF_CACHE_PATH, max_size=None, max_age=None, refresh=False):
+        if self.cache != None:
+            self.cache.close()
+        from .cache import ResponseCache
+        self.cache = None if path == None else ResponseCache(path, max_size=max_size, max_age=max_age, refresh=refresh)
+
+    # Opt-in: at temperature 0 every voter would receive the same answer, so
+    # only one response per problem is requested and copied to all voters
+    def set_collapse_voters(self, collapse_voters):
+        self.collapse_voters = collapse_voters
+
+    def cache_stats(self):
+        return None if self.cache == None else self.cache.stats()
+
+    # Tokens used by this process through the pipe; cached_tokens (and
+    # cache_hit_rate) count the prompt tokens served from the provider's
+    # prefix cache
+    def usage_stats(self):
+        return get_usage(self.pipename)
+
+    # Latency, queue wait, retry, failure, token and throughput metrics of
+    # the calls made to the pipe by this process (see falcon.metrics)
+    def metrics(self):
+        from .metrics import get_metrics
+        return get_metrics(self.pipename).snapshot()
+
     def get_max_tokens(self):
         return self.max_tokens 
 
@@ -70,81 +209,302 @@ class Challenger:
             self.template = template
 
     def compile_problems(self, statements, hints=None):
+        if hints != None and len(statements) != len(hints):
+            raise Exception("Number of problems and number of hints must the same")
+        return list(self.iter_compile_problems(statements, hints))
+
+    # Lazy version of compile_problems for arbitrary iterables
+    def iter_compile_problems(self, statements, hints=None):
         local_template = self.template.strip()
         if hints != None:
-            if len(statements) != len(hints):
-                raise Exception("Number of problems and number of hints must the same")
             if local_template.find("{hint}") == -1:
                 if self.default_template:
                     local_template = DEFAULT_HINT_TEMPLATE
                 else:
                     raise Exception("To parse hints your problem template must include a {hint} attribute")
 
-        output = []
-        index = 0
+        if hints == None:
+            for statement in statements:
+                yield self._compile_prompt(local_template, statement)
+        else:
+            try:
+                for statement, hint in zip(statements, hints, strict=True):
+                    yield self._compile_prompt(local_template, statement, hint)
+            except ValueError:
+                raise Exception("Number of problems and number of hints must the same")
 
-        for statement in statements:
-            prompt = "Please reason step by step, and put your final answer within \\boxed{} at the end of the solution. "
-            prompt += local_template.replace("{statement}", statement.strip())
-            if hints != None:
-                prompt = prompt.replace("{hint}", hints[index].strip())
-                index += 1
-            output.append(prompt)
-        
-        return output
+    def _compile_prompt(self, template, statement, hint=None):
+        prompt = "Please reason step by step, and put your final answer within \\boxed{} at the end of the solution. "
+        prompt += template.replace("{statement}", statement.strip())
+        if hint != None:
+            prompt = prompt.replace("{hint}", hint.strip())
+        return prompt
 
+    # See falcon.answers.extract_answer
     @staticmethod
     def extract_answers(solutions):
-        answers = []
-        for solution in solutions:
-            ind_start = solution.rfind("boxed{") + len("boxed{")
-            ind_end = solution.find("}", ind_start)
-            if ind_start == -1 or ind_end == -1:
-                answers.append(None)
+        return extract_answers(solutions)
+
+    # With early_stop=True (requires vote=True) voters are requested in waves
+    # of `wave` samples per problem (default: a quarter of the voters), and a
+    # problem stops receiving samples once its leading answer cannot be
+    # overtaken by the remaining voters or holds at least `confidence` of the
+    # votes cast so far. Each problem starts its next wave as soon as its own
+    # previous one is back.
+    # With resume=<path> every response is checkpointed to a journal file as it
+    # arrives; calling again with the same path skips the journaled work.
+    # deadline: seconds the run may take; cancel: a CancelToken stopping it early.
+    # Problems left unanswered when the run stops are returned as FailedRequest
+    # records with reason "deadline_exceeded" or "cancelled".
+    def solve_problems(self, problems, hints=None, output_type='solutions', voters=1, vote=True, early_stop=False, wave=None, confidence=None, resume=None, deadline=None, cancel=None):
+        from .scheduler import Scheduler
+        from .journal import Journal
+        prompts = self._prepare_prompts(problems, hints, output_type)
+        if early_stop and not vote:
+            raise Exception("Early stopping requires vote=True")
+        journal = None if resume == None else Journal(resume)
+        try:
+            s = self._scheduler(Scheduler, self.pipeline.retrieve_response, journal=journal, cancel=self._cancel_token(deadline, cancel))
+            if early_stop:
+                return self._solve_early_stop(s, prompts, output_type, voters, wave, confidence)
+            model_output = s.run(prompts, **self._request_kwargs(voters, output_type))
+            return self._collect_results(model_output, output_type, vote)
+        finally:
+            if journal != None:
+                journal.close()
+
+    def _solve_early_stop(self, s, prompts, output_type, voters, wave, confidence):
+        from .retry import FailedRequest
+        solutions = [[] for _ in prompts]
+        results = [None] * len(prompts)
+        wave = wave if wave != None else math.ceil(voters / 4)
+        decided = lambda responses, remaining: self._vote_decided(responses, remaining, confidence)
+
+        for k, res in s.run_waves(prompts, wave, decided, **self._request_kwargs(voters, output_type)):
+            if isinstance(res, FailedRequest):
+                # Vote on what arrived so far, or report the failure
+                results[k] = res
             else:
-                ans = solution[ind_start:ind_end:]
-                answers.append(ans)
-        return answers
+                solutions[k] += res
+
+        for i in range(len(prompts)):
+            if len(solutions[i]) > 0:
+                results[i] = self._do_voting(solutions[i], output_type=output_type)
+        return s.mark_unfinished(results)
+
+    def _vote_decided(self, solutions, remaining, confidence):
+        if remaining <= 0:
+            return True
+        counts = {}
+        for answer in self.extract_answers(solutions):
+            answer = canonicalize(answer)
+            counts[answer] = counts.get(answer, 0) + 1
+        votes = sorted(counts.values(), reverse=True) + [0, 0]
+        if votes[0] > votes[1] + remaining:
+            return True
+        return confidence != None and votes[0] >= MIN_CONFIDENCE_VOTES and votes[0] / len(solutions) >= confidence
+
+    # Streaming version of solve_problems: accepts any iterable of problems
+    # (and hints), keeps at most `window` prompts in flight and yields
+    # (index, result) pairs as they complete.
+    # Once stopped by `deadline` or `cancel`, the stream ends after the requests
+    # in flight; problems not yet read from `problems` are not yielded.
+    def solve_problems_iter(self, problems, hints=None, output_type='solutions', voters=1, vote=True, window=None, resume=None, deadline=None, cancel=None):
+        if output_type != 'solutions' and output_type != 'answers':
+            raise Exception("Output type be either 'solutions' or 'answers'")
+        from .scheduler import Scheduler
+        from .journal import Journal
+        prompts = self.iter_compile_problems(problems, hints)
+        journal = None if resume == None else Journal(resume)
+        try:
+            s = self._scheduler(Scheduler, self.pipeline.retrieve_response, journal=journal, cancel=self._cancel_token(deadline, cancel))
+            for idx, res in s.run_iter(prompts, window=window, **self._request_kwargs(voters, output_type)):
+                yield idx, self._collect_result(res, output_type, vote)
+        finally:
+            if journal != None:
+                journal.close()
+
+    async def asolve_problems(self, problems, hints=None, output_type='solutions', voters=1, vote=True, deadline=None, cancel=None):
+        prompts = self._prepare_prompts(problems, hints, output_type)
+        # Pipes without a coroutine fall back to the thread-based sync function
+        function = self.pipeline.aretrieve_response if self.pipeline.has_async() else self.pipeline.retrieve_response
+        from .async_scheduler import AsyncScheduler
+        s = self._scheduler(AsyncScheduler, function, cancel=self._cancel_token(deadline, cancel))
+        model_output = await s.run(prompts, **self._request_kwargs(voters, output_type))
+        return self._collect_results(model_output, output_type, vote)
+
+    def _session_executor(self):
+        # (Re)configure the pipe's connection pool and worker threads
+        # whenever the concurrency or connection options change
+        config = (self.concurrent_requests, self.keepalive_expiry, self.http2)
+        if config != self.client_config:
+            # Pipes taking client_options get them with every call instead
+            if self.pipeline.configure_client != None and not self.pipeline.supports_client_options():
+                self.pipeline.configure_client(**self._client_options())
+            self.close()
+            self.client_config = config
+        if self.executor == None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrent_requests)
+        return self.executor
 
-    def solve_problems(self, problems, hints=None, output_type='solutions', voters=1, vote=True):
+    def _cancel_token(self, deadline, cancel):
+        return cancel if deadline == None else CancelToken(deadline, parent=cancel)
+
+    def _scheduler(self, scheduler_class, function, journal=None, cancel=None):
+        from .retry import get_circuit_breaker
+        from .metrics import get_metrics
+        return scheduler_class(
+            function,
+            concurrent_requests=self.concurrent_requests,
+            max_retries=self.max_retries,
+            delay=self.delay,
+            rate_limiter=self._rate_limiter(),
+            retry_policy=self._retry_policy(),
+            circuit_breaker=get_circuit_breaker(self.pipename),
+            fan_out=self.pipeline.needs_fan_out(),
+            max_choices=self.pipeline.MAX_CHOICES,
+            cache=self.cache,
+            cache_namespace=self.pipename,
+            collapse_voters=self.collapse_voters,
+            journal=journal,
+            executor=self._session_executor(),
+            budget=get_provider_budget(self.pipename),
+            priority=self.priority,
+            hedge=self.hedge,
+            fallback=self._fallback_scheduler(scheduler_class),
+            fallback_kwargs=self._fallback_kwargs(),
+            cancel=cancel,
+            metrics=get_metrics(self.pipename)
+        )
+
+    def _fallback_scheduler(self, scheduler_class):
+        if self.hedge == None or self.fallback_pipe == None or self.fallback_pipe == self.pipename:
+            return None
+        from .scheduler import Scheduler
+        from .retry import get_circuit_breaker
+        from .metrics import get_metrics
+        pipeline = Pipeline(self.fallback_pipe)
+        function = pipeline.retrieve_response
+        if scheduler_class != Scheduler and pipeline.has_async():
+            function = pipeline.aretrieve_response
+        return scheduler_class(
+            function,
+            concurrent_requests=self.concurrent_requests,
+            max_retries=self.max_retries,
+            delay=self.delay,
+            rate_limiter=self._fallback_limiter(),
+            retry_policy=self._retry_policy(),
+            circuit_breaker=get_circuit_breaker(self.fallback_pipe),
+            fan_out=pipeline.needs_fan_out(),
+            max_choices=pipeline.MAX_CHOICES,
+            executor=self._session_executor(),
+            budget=get_provider_budget(self.fallback_pipe),
+            priority=self.priority,
+            metrics=get_metrics(self.fallback_pipe)
+        )
+
+    # The fallback pipe model has its own budgets, set by the Challengers
+    # using it
+    def _fallback_limiter(self):
+        budget = get_rate_budget(self.fallback_pipe, self._fallback_kwargs()["model"])
+        if len(self.budget_settings) == 0 and not budget.limited():
+            return None
+        return RateLimiter(budget, max_concurrency=self.concurrent_requests, adaptive=self.adaptive_concurrency)
+
+    def _fallback_kwargs(self):
+        kwargs = {}
+        if self.fallback_pipe != None and self.fallback_pipe != self.pipename:
+            pipeline = Pipeline(self.fallback_pipe)
+            kwargs["model"] = pipeline.DEF_MODEL
+            if not pipeline.supports_stop_on_answer():
+                # None removes the parameter from the hedged call
+                kwargs["stop_on_answer"] = None
+                kwargs["answer_grace"] = None
+            if not pipeline.supports_client_options():
+                kwargs["client_options"] = None
+        if self.fallback_model != None:
+            kwargs["model"] = self.fallback_model
+        return kwargs
+
+    def _prepare_prompts(self, problems, hints, output_type):
         if hints != None and len(problems) != len(hints):
             raise Exception("Number of problems and number of hints must the same")
         if output_type != 'solutions' and output_type != 'answers':
             raise Exception("Output type be either 'solutions' or 'answers'")
-        prompts = self.compile_problems(problems, hints)
-        total_count = len(prompts)
-        current_count = 0
-        s = Scheduler(self.pipeline.retrieve_response)
+        return self.compile_problems(problems, hints)
+
+    def _request_kwargs(self, voters, output_type=None):
         kwargs = {
             "model": self.model,
             "temperature": self.temperature,
-            "response_count": voters
+            "response_count": voters,
+            "max_tokens": self.max_tokens
         }
-        model_output = s.run(prompts, **kwargs)
-        results = []
-        for res in model_output:
-            # res = self.pipeline.retrieve_response(prompt, model=self.model, temperature=self.temperature, response_count=voters)
-            if vote:
-                solution = self._do_voting(res, output_type=output_type)
-                results.append(solution)
-            else: 
-                if output_type == 'solutions':
-                    results.append(res)
-                else:
-                    results.append(self.extract_answers(res))
-            
-            current_count += 1
-        return results
+        if self._stops_on_answer(output_type):
+            kwargs["stop_on_answer"] = True
+            kwargs["answer_grace"] = self.answer_grace
+        if self.system_prompt != None:
+            kwargs["system_prompt"] = self.system_prompt
+        if self.timeout != None:
+            kwargs["timeout"] = self.timeout
+        if self.pipeline.supports_client_options():
+            kwargs["client_options"] = self._client_options()
+        return kwargs
+
+    # Connection options sent with every call to pipes supporting them, so
+    # each Challenger gets a client sized for its own concurrency
+    def _client_options(self):
+        return {"max_connections": self.concurrent_requests, "keepalive_expiry": self.keepalive_expiry, "http2": self.http2}
+
+    def _stops_on_answer(self, output_type):
+        return self.stop_on_answer and output_type == 'answers' and self.pipeline.supports_stop_on_answer()
+
+    def _retry_policy(self):
+        if self.retry_policy != None:
+            return self.retry_policy
+        from .retry import RetryPolicy
+        return RetryPolicy(max_retries=self.max_retries)
+
+    # The pipe model's shared budgets behind this Challenger's concurrency
+    # limiter; None (no limiter) while neither this Challenger nor any other
+    # using the model has set rate limits
+    def _rate_limiter(self):
+        budget = get_rate_budget(self.pipename, self.model, **self.budget_settings)
+        if len(self.budget_settings) == 0 and not budget.limited():
+            return None
+        if self.rate_limiter == None or self.rate_limiter.budget is not budget:
+            self.rate_limiter = RateLimiter(budget, max_concurrency=self.concurrent_requests, adaptive=self.adaptive_concurrency)
+        else:
+            self.rate_limiter.configure(max_concurrency=self.concurrent_requests, adaptive=self.adaptive_concurrency)
+        return self.rate_limiter
+
+    def _collect_results(self, model_output, output_type, vote):
+        return [self._collect_result(res, output_type, vote) for res in model_output]
 
+    def _collect_result(self, res, output_type, vote):
+        from .retry import FailedRequest
+        # Failures are passed through as explicit records
+        if isinstance(res, FailedRequest):
+            return res
+        if vote:
+            return self._do_voting(res, output_type=output_type)
+        if output_type == 'solutions':
+            return res
+        return self.extract_answers(res)
+
+    # Answers vote in canonical form (see falcon.equivalence), so "0.5" and
+    # "\frac{1}{2}" count together; the winner is returned as first written
     def _do_voting(self, solutions, output_type='solutions'):
         candidates = {}
         answers = self.extract_answers(solutions)
         index = 0
         for answer in answers:
-            if answer in candidates:
-                candidates[answer]["count"] += 1
+            key = canonicalize(answer)
+            if key in candidates:
+                candidates[key]["count"] += 1
             else:
-                candidates[answer] = {"count": 1, "index": index}
+                candidates[key] = {"count": 1, "index": index}
             index += 1
         max_key = None
         max_votes = 0
@@ -152,44 +512,148 @@ class Challenger:
             if candidates[candidate]["count"] > max_votes:
                 max_key = candidate
                 max_votes = candidates[candidate]["count"]
-        return solutions[candidates[max_key]['index']] if output_type == 'solutions' else max_key
+        index = candidates[max_key]['index']
+        return solutions[index] if output_type == 'solutions' else answers[index]
 
     def send_problems(self, problems, hints=None, voters=1):
         if hints != None and len(problems) != len(hints):
             raise Exception("Number of problems and number of hints must the same")
         prompts = self.compile_problems(problems, hints)
+        return self._send_prompts(prompts, voters)
+
+    def _send_prompts(self, prompts, voters):
+        system_prompts = None if self.system_prompt == None else [self.system_prompt] * len(prompts)
         if self.gpus:
             return self.pipeline.send_batch(
                 prompts, 
+                system_prompts=system_prompts,
                 model=self.model, 
                 temperature=self.temperature, 
                 response_count=voters,
                 gpu_type=self.gpu_type,
-                gpu_count=self.gpu_count
+                gpu_count=self.gpu_count,
+                # The output type is only known at retrieval: a vLLM batch
+                # stops on its answers whenever set_stop_on_answer is on
+                stop_on_answer=self.stop_on_answer,
+                answer_grace=self.answer_grace
             )
-        return self.pipeline.send_batch(prompts, model=self.model, temperature=self.temperature, response_count=voters)
+        return self.pipeline.send_batch(prompts, system_prompts=system_prompts, model=self.model, temperature=self.temperature, response_count=voters)
 
-    def retrieve_problems(self, batch_id, output_type='solutions', vote=True):
+    # Problems a finished batch did not answer are FailedRequest records; with
+    # resubmit=True they are sent again through the sync scheduler instead
+    def retrieve_problems(self, batch_id, output_type='solutions', vote=True, resubmit=False):
         if output_type != 'solutions' and output_type != 'answers':
             raise Exception("Output type must be either 'solutions' or 'answers'")
         results = self.pipeline.retrieve_batch(batch_id)
 
         if results == None:
             return None
-        
-        output = []
 
+        if resubmit and self.pipeline.failed_requests != None:
+            results = self._rerun_failed(batch_id, results)
 
-        if vote:
-            for res in results:
-                solution = self._do_voting(res, output_type=output_type)
-                output.append(solution)
-        
-        else:
-            if output_type == 'solutions':
-                output = results
+        return self._collect_results(results, output_type, vote)
+
+    # Sends the unanswered requests of a finished batch as new batches and
+    # returns the id to pass to retrieve_problems(...) for the whole job
+    def resubmit_problems(self, batch_id):
+        if self.pipeline.resubmit_batch == None:
+            raise Exception("The pipe '" + self.pipename + "' does not support resubmitting batches")
+        return self.pipeline.resubmit_batch(batch_id)
+
+    def _rerun_failed(self, batch_id, results):
+        from .scheduler import Scheduler
+        # Requests sharing their parameters go through one scheduler run
+        groups = {}
+        for request in self.pipeline.failed_requests(batch_id, results):
+            key = (request["model"], request["temperature"], request["max_tokens"], request["response_count"], request["system_prompt"])
+            groups.setdefault(key, []).append(request)
+        results = list(results)
+        for (model, temperature, max_tokens, response_count, system_prompt), requests in groups.items():
+            # The batch's own settings over this Challenger's (timeout, client options)
+            kwargs = self._request_kwargs(response_count)
+            kwargs.update(model=model, temperature=temperature, max_tokens=max_tokens)
+            kwargs.pop("system_prompt", None)
+            if system_prompt != None:
+                kwargs["system_prompt"] = system_prompt
+            s = self._scheduler(Scheduler, self.pipeline.retrieve_response)
+            for request, res in zip(requests, s.run([request["prompt"] for request in requests], **kwargs)):
+                results[request["index"]] = res
+        return results
+
+    # Splits the problems between the pipe's batch API and the sync scheduler
+    # (see falcon.routing.plan_route): `urgent` problems (indices), small
+    # workloads, pipes without a batch API and short deadlines go through the
+    # scheduler, the rest is sent as a batch for its lower price. The sync part
+    # is answered before this returns; pass the returned run to
+    # collect_problems(...) for the results of every problem.
+    # deadline: seconds the whole run may take; cancel: a CancelToken stopping it.
+    def route_problems(self, problems, hints=None, voters=1, deadline=None, urgent=None, cancel=None, min_batch_requests=MIN_BATCH_REQUESTS):
+        if hints != None and len(problems) != len(hints):
+            raise Exception("Number of problems and number of hints must the same")
+        prompts = self.compile_problems(problems, hints)
+        sync_indices, batch_indices = plan_route(
+            len(prompts),
+            voters,
+            self.pipeline.BATCH_WINDOW,
+            deadline=deadline,
+            urgent=urgent,
+            min_batch_requests=min_batch_requests
+        )
+        run = RoutedRun(prompts, voters, sync_indices, batch_indices, cancel=self._cancel_token(deadline, cancel))
+        if len(batch_indices) > 0:
+            run.batch_id = self._send_prompts([prompts[i] for i in batch_indices], voters)
+            if deadline != None:
+                run.cutoff = time.monotonic() + deadline * BATCH_SHARE
+        self._run_routed(run, sync_indices)
+        return run
+
+    # Results of a routed run, in the order of its problems. Until the batch
+    # has finished this waits (polling every poll_interval seconds), or returns
+    # None with wait=False. Problems the batch did not answer are sent through
+    # the sync scheduler. A batch still running at the run's cutoff (BATCH_SHARE
+    # of the deadline) is cancelled and waited for up to CANCEL_WAIT seconds
+    # more, so that only the problems it left unanswered are sent; if it has
+    # not wound down by then, or once the run is cancelled, all its problems are.
+    def collect_problems(self, run, output_type='solutions', vote=True, wait=True, poll_interval=POLL_INTERVAL):
+        if output_type != 'solutions' and output_type != 'answers':
+            raise Exception("Output type must be either 'solutions' or 'answers'")
+        from .retry import FailedRequest
+        while not run.done():
+            results = self.pipeline.retrieve_batch(run.batch_id)
+            if results != None:
+                for i, res in zip(run.batch_indices, results):
+                    run.output[i] = res
+                self._run_routed(run, [i for i in run.batch_indices if isinstance(run.output[i], FailedRequest)], rerouted=True)
+            elif run.past_cancel_cutoff() or (run.cancel != None and run.cancel.stopped()):
+                if run.cancel_cutoff == None and self.pipeline.cancel_batch != None:
+                    self.pipeline.cancel_batch(run.batch_id)
+                self._run_routed(run, run.batch_indices, rerouted=True)
+            elif run.cancel_cutoff == None and run.past_cutoff():
+                if self.pipeline.cancel_batch == None:
+                    self._run_routed(run, run.batch_indices, rerouted=True)
+                    continue
+                # A cancelled batch returns the requests it finished once it
+                # has wound down
+                self.pipeline.cancel_batch(run.batch_id)
+                run.wait_for_cancel()
+            elif not wait:
+                return None
             else:
-                for problem in results:
-                    output.append(self.extract_answers(problem))
+                cutoff = run.cutoff if run.cancel_cutoff == None else run.cancel_cutoff
+                delay = poll_interval if cutoff == None else max(0, min(poll_interval, cutoff - time.monotonic()))
+                if run.cancel != None:
+                    run.cancel.wait(delay)
+                else:
+                    time.sleep(delay)
+        return self._collect_results([run.output[i] for i in range(len(run.prompts))], output_type, vote)
 
-        return output
\ No newline at end of file
+    def _run_routed(self, run, indices, rerouted=False):
+        if len(indices) == 0:
+            return
+        from .scheduler import Scheduler
+        s = self._scheduler(Scheduler, self.pipeline.retrieve_response, cancel=run.cancel)
+        for i, res in zip(indices, s.run([run.prompts[i] for i in indices], **self._request_kwargs(run.voters))):
+            run.output[i] = res
+        if rerouted:
+            run.rerouted += len(indices)
@@ -0,0 +1,234 @@
+import re
+import signal
+import functools
+import threading
+import contextlib
+
+# Distinct raw answers whose canonical form is kept; answers repeat heavily
+# across voters and problems, so most lookups are hits
+CANONICAL_CACHE_SIZE = 1 << 16
+# Seconds a single symbolic check may take; a check running longer counts
+# as "not equal"
+SYMBOLIC_TIMEOUT = 5
+# Longest expression (after conversion from LaTeX) given to sympy
+SYMBOLIC_MAX_LENGTH = 200
+
+# Spacing and sizing commands that do not change an answer
+_DROPPED = ["\\left", "\\right", "\\!", "\\,", "\\;", "\\:", "\\ ", "~", "\\displaystyle", "^\\circ", "^{\\circ}", "\\%", "%", "\\$", "$"]
+_RENAMED = [("\\dfrac", "\\frac"), ("\\tfrac", "\\frac"), ("\\le", "\\leq"), ("\\ge", "\\geq"), ("\\leqq", "\\leq"), ("\\geqq", "\\geq")]
+# \text{cm}, \mathrm{B}, \mbox{...}: keep the argument
+_TEXT = re.compile(r"\\(?:text|textbf|mathrm|mathbf|mbox|operatorname)\{([^{}]*)\}")
+# \frac12, \frac1{2}, \sqrt3: single-character arguments without braces
+_FRAC_SHORT = re.compile(r"\\frac(?:([0-9a-zA-Z])|\{([^{}]*)\})(?:([0-9a-zA-Z])|\{([^{}]*)\})")
+_SQRT_SHORT = re.compile(r"\\sqrt([0-9a-zA-Z])")
+# "x = 5", "y=\frac{1}{2}": a single variable being assigned the answer
+_ASSIGNMENT = re.compile(r"^[a-zA-Z]\s*=\s*(?![=<>])")
+_THOUSANDS = re.compile(r"^-?\d{1,3}(?:,\d{3})+(?:\.\d+)?$")
+_NUMBER = re.compile(r"^-?(?:\d+\.?\d*|\.\d+)$")
+_FRACTION = re.compile(r"^(-?)(?:\\frac\{(-?\d+)\}\{(-?\d+)\}|(-?\d+)/(-?\d+))$")
+
+
+# Canonical form of an answer: LaTeX spacing, sizing and text commands are
+# dropped, \dfrac and \frac12 are written \frac{1}{2}, a leading "x =" is
+# removed and numbers (integers, decimals, fractions, "1,000") become an
+# exact "p/q" or "n", so "0.5", "\frac12" and "1/2" all give "1/2".
+# Anything else is returned cleaned up but otherwise as written.
+@functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonicalize(answer):
+    if answer == None:
+        return None
+    text = str(answer).strip()
+    for command, name in _RENAMED:
+        text = re.sub(re.escape(command) + r"(?![a-zA-Z])", lambda _: name, text)
+    for dropped in _DROPPED:
+        text = text.replace(dropped, "")
+    previous = None
+    while previous != text:
+        previous = text
+        text = _TEXT.sub(r"\1", text)
+    text = _FRAC_SHORT.sub(lambda match: "\\frac{%s}{%s}" % (match.group(1) or match.group(2), match.group(3) or match.group(4)), text)
+    text = _SQRT_SHORT.sub(r"\\sqrt{\1}", text)
+    text = _ASSIGNMENT.sub("", text)
+    text = text.strip().rstrip(".").replace(" ", "")
+    number = _to_number(text)
+    if number != None:
+        return str(number)
+    return text
+
+
+def _to_number(text):
+    # Imported here: fractions pulls in decimal, which is slow to import
+    from fractions import Fraction
+    if _THOUSANDS.match(text):
+        text = text.replace(",", "")
+    if _NUMBER.match(text):
+        return Fraction(text)
+    match = _FRACTION.match(text)
+    if match == None:
+        return None
+    numerator = int(match.group(2) or match.group(4))
+    denominator = int(match.group(3) or match.group(5))
+    if denominator == 0:
+        return None
+    number = Fraction(numerator, denominator)
+    return -number if match.group(1) else number
+
+
+def answers_equivalent(answer, truth, symbolic=False):
+    answer = canonicalize(answer)
+    truth = canonicalize(truth)
+    if answer == None or truth == None:
+        return False
+    if answer == truth:
+        return True
+    if not symbolic:
+        return False
+    _require_sympy()
+    return _symbolic_equal(truth, answer)
+
+
+# For each problem, the given answers that are equivalent to its ground
+# truth: problems is a list of (truth, answers). Answers are compared in
+# canonical form first; with symbolic=True those that still differ go
+# through sympy, one task per problem with its distinct answers, spread
+# over a pool of `workers` processes (None: one per CPU, 0: no pool).
+# Returns a list of sets of the raw answers found equivalent.
+def equivalent_answers(problems, symbolic=False, workers=None):
+    matches = []
+    pending = []
+    for index, (truth, answers) in enumerate(problems):
+        truth = canonicalize(truth)
+        matched = set()
+        unmatched = set()
+        for answer in set(answers):
+            canonical = canonicalize(answer)
+            if canonical == None or truth == None:
+                continue
+            if canonical == truth:
+                matched.add(answer)
+            else:
+                unmatched.add(answer)
+        matches.append(matched)
+        if symbolic and len(unmatched) > 0:
+            pending.append((index, truth, tuple(unmatched)))
+    if len(pending) == 0:
+        return matches
+    tasks = [(truth, tuple(canonicalize(answer) for answer in answers)) for _, truth, answers in pending]
+    _require_sympy()
+    if workers == 0:
+        results = [_symbolic_check(task) for task in tasks]
+    else:
+        results = _symbolic_pool(tasks, workers)
+    for (index, _, answers), equal in zip(pending, results):
+        matches[index].update(answer for answer, same in zip(answers, equal) if same)
+    return matches
+
+
+# One future per problem, each waited for at most SYMBOLIC_TIMEOUT per answer
+# (the workers also stop every check after SYMBOLIC_TIMEOUT, see
+# _time_limit; this catches work a signal cannot interrupt, such as a huge
+# integer power). A problem that times out gets "not equal" for all its
+# answers, and the worker processes still busy are terminated.
+def _symbolic_pool(tasks, workers):
+    # Imported here: multiprocessing is slow to import and rarely needed
+    from concurrent.futures import ProcessPoolExecutor, TimeoutError
+    executor = ProcessPoolExecutor(max_workers=workers)
+    timed_out = False
+    results = []
+    try:
+        futures = [executor.submit(_symbolic_check, task) for task in tasks]
+        for (_, answers), future in zip(tasks, futures):
+            try:
+                results.append(future.result(timeout=SYMBOLIC_TIMEOUT * len(answers) + 1))
+            except TimeoutError:
+                timed_out = True
+                results.append([False] * len(answers))
+    finally:
+        if timed_out:
+            # A stuck worker would block shutdown() forever
+            for process in list(getattr(executor, "_processes", {}).values()):
+                process.terminate()
+        executor.shutdown(wait=not timed_out, cancel_futures=True)
+    return results
+
+
+def _require_sympy():
+    try:
+        import sympy
+    except ImportError:
+        raise Exception("Symbolic equivalence requires sympy (pip install sympy).")
+
+
+# Run in the worker processes: whether each canonical answer equals truth
+def _symbolic_check(task):
+    truth, answers = task
+    return [_symbolic_equal(truth, answer) for answer in answers]
+
+
+@functools.lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def _symbolic_equal(truth, answer):
+    import sympy
+    try:
+        with _time_limit(SYMBOLIC_TIMEOUT):
+            difference = sympy.simplify(_to_sympy(truth) - _to_sympy(answer))
+            return difference == 0
+    except Exception:
+        return False
+
+
+class _SymbolicTimeout(Exception):
+    pass
+
+
+# Raises _SymbolicTimeout in the block after `seconds`, where SIGALRM can be
+# used (POSIX, main thread: the case in the worker processes); elsewhere the
+# block runs unlimited
+@contextlib.contextmanager
+def _time_limit(seconds):
+    if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def expire(signum, frame):
+        raise _SymbolicTimeout()
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+_LATEX_TO_SYMPY = [
+    (re.compile(r"\\frac\{([^{}]*)\}\{([^{}]*)\}"), r"((\1)/(\2))"),
+    (re.compile(r"\\sqrt\[([^\]]*)\]\{([^{}]*)\}"), r"((\2)**(1/(\1)))"),
+    (re.compile(r"\\sqrt\{([^{}]*)\}"), r"sqrt(\1)")
+]
+_LATEX_SYMBOLS = [("\\cdot", "*"), ("\\times", "*"), ("\\pi", "pi"), ("^", "**"), ("{", "("), ("}", ")"), ("\\", "")]
+# parse_expr evaluates its input with eval(), so only arithmetic on numbers,
+# single-letter variables and these functions is let through
+_SYMPY_NAMES = {"sqrt", "pi", "sin", "cos", "tan", "log", "ln", "exp"}
+_SYMPY_CHARACTERS = re.compile(r"^[0-9a-zA-Z+\-*/()., ]*$")
+_SYMPY_WORD = re.compile(r"[a-zA-Z]+")
+
+
+def _to_sympy(text):
+    from sympy.parsing.sympy_parser import parse_expr, standard_transformations, implicit_multiplication_application
+    previous = None
+    while previous != text:
+        previous = text
+        for pattern, replacement in _LATEX_TO_SYMPY:
+            text = pattern.sub(replacement, text)
+    for symbol, replacement in _LATEX_SYMBOLS:
+        text = text.replace(symbol, replacement)
+    if not _safe_expression(text):
+        raise Exception(f"Not a plain arithmetic expression: {text!r}")
+    return parse_expr(text, transformations=standard_transformations + (implicit_multiplication_application,), evaluate=True)
+
+
+def _safe_expression(text):
+    if len(text) > SYMBOLIC_MAX_LENGTH or not _SYMPY_CHARACTERS.match(text):
+        return False
+    return all(len(word) == 1 or word in _SYMPY_NAMES for word in _SYMPY_WORD.findall(text))
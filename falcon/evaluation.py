@@ -0,0 +1,164 @@
+import numpy
+from .answers import extract_answers
+from .equivalence import canonicalize, equivalent_answers
+from .grader import Grader, DEF_KS, DEF_RESAMPLES, DEF_CONFIDENCE
+
+# Bootstrap resamples drawn at a time, to bound the memory of the weights
+BOOTSTRAP_CHUNK = 100
+
+
+class CorrectnessMatrix:
+    # The graded samples of a run as arrays, built once:
+    #   correct     problems x samples, 1 where the sample is correct
+    #   answer_ids  problems x samples, the sample's answer numbered per
+    #               problem in order of first appearance (by canonical form,
+    #               as in Challenger voting), -1 past the problem's samples
+    #   id_correct  problems x answers, whether each numbered answer is correct
+    #   samples     samples per problem (0 for a failed problem)
+    def __init__(self, answers_list, answers_ground_truth, symbolic=False, workers=None):
+        if len(answers_list) != len(answers_ground_truth):
+            raise Exception("Number of answers lists must the same as the number of answers in the ground truth list.")
+        answers_list = [Grader._answers(answers, "Each item in answers_list must be a list of answers.") or [] for answers in answers_list]
+        problems = [(str(truth), answers) for answers, truth in zip(answers_list, answers_ground_truth)]
+        matches = equivalent_answers(problems, symbolic=symbolic, workers=workers)
+
+        width = max([len(answers) for answers in answers_list] + [0])
+        answer_ids = []
+        id_correct = []
+        for answers, correct in zip(answers_list, matches):
+            ids = {}
+            row_ids = []
+            row_correct = []
+            for answer in answers:
+                key = canonicalize(answer)
+                if key not in ids:
+                    ids[key] = len(ids)
+                    row_correct.append(answer in correct)
+                row_ids.append(ids[key])
+            answer_ids.append(row_ids + [-1] * (width - len(row_ids)))
+            id_correct.append(row_correct)
+        answers_width = max([len(row) for row in id_correct] + [0])
+        self.samples = numpy.array([len(answers) for answers in answers_list], dtype=numpy.int64)
+        self.answer_ids = numpy.array(answer_ids, dtype=numpy.int32).reshape(len(answers_list), width)
+        self.id_correct = numpy.array([row + [False] * (answers_width - len(row)) for row in id_correct], dtype=bool).reshape(len(answers_list), answers_width)
+        # A sample is correct when its answer is
+        padded = numpy.concatenate([self.id_correct, numpy.zeros((len(answers_list), 1), dtype=bool)], axis=1)
+        self.correct = numpy.take_along_axis(padded, numpy.where(self.answer_ids >= 0, self.answer_ids, answers_width), axis=1).astype(numpy.uint8)
+
+    @classmethod
+    def from_solutions(cls, solutions_list, answers_ground_truth, symbolic=False, workers=None):
+        answers_list = []
+        for solutions in solutions_list:
+            solutions = Grader._answers(solutions, "Each item in answers_list must be a list of answers or an answer.")
+            answers_list.append(None if solutions == None else extract_answers(solutions))
+        return cls(answers_list, answers_ground_truth, symbolic=symbolic, workers=workers)
+
+    # Unbiased pass@k estimate, 1 - C(n - c, k) / C(n, k), for every problem
+    # (rows) and k (columns); NaN where a problem has fewer than k samples
+    def pass_at_k(self, ks):
+        ks = numpy.asarray(ks, dtype=numpy.int64)[None, :]
+        n = self.samples[:, None]
+        c = self.correct.sum(axis=1, dtype=numpy.int64)[:, None]
+        # log(m!) for m = 0..max(n)
+        log_factorial = numpy.concatenate([[0.0], numpy.cumsum(numpy.log(numpy.arange(1, max(int(n.max(initial=0)), 1) + 1)))])
+        wrong = n - c
+        possible = wrong >= ks
+        # C(n - c, k) / C(n, k) = (n - c)! (n - k)! / ((n - c - k)! n!)
+        log_ratio = (log_factorial[wrong] + log_factorial[numpy.clip(n - ks, 0, None)]
+                     - log_factorial[numpy.clip(wrong - ks, 0, None)] - log_factorial[n])
+        estimate = numpy.where(possible, 1.0 - numpy.exp(log_ratio), 1.0)
+        return numpy.where(n >= ks, estimate, numpy.nan)
+
+    # maj@k: whether the majority answer of the first k samples is correct,
+    # ties going to the answer seen first; NaN where a problem has fewer
+    # than k samples. All ks are read off one pass over the sample columns.
+    def maj_at_k(self, ks):
+        ks = [int(k) for k in ks]
+        count, width = self.answer_ids.shape
+        rows = numpy.arange(count)
+        votes = numpy.zeros((count, max(self.id_correct.shape[1], 1)), dtype=numpy.int32)
+        output = numpy.full((count, len(ks)), numpy.nan)
+        for column in range(min(max(ks, default=0), width)):
+            ids = self.answer_ids[:, column]
+            present = ids >= 0
+            votes[rows[present], ids[present]] += 1
+            k = column + 1
+            if k not in ks:
+                continue
+            winners = votes.argmax(axis=1)
+            decided = self.id_correct[rows, winners] if self.id_correct.shape[1] > 0 else numpy.zeros(count, dtype=bool)
+            value = numpy.where(self.samples >= k, decided, numpy.nan)
+            for index, wanted in enumerate(ks):
+                if wanted == k:
+                    output[:, index] = value
+        return output
+
+
+# Mean over problems of each column of values (problems x metrics), NaN
+# entries left out, with a percentile bootstrap confidence interval from
+# `resamples` resamples of the problems. Each resample is a vector of draw
+# counts per problem, so a chunk of them is a single matrix product. Returns three arrays:
+# mean, low and high (low and high are NaN with resamples=0).
+def bootstrap_ci(values, resamples=DEF_RESAMPLES, confidence=DEF_CONFIDENCE, seed=None):
+    values = numpy.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    valid = ~numpy.isnan(values)
+    filled = numpy.where(valid, values, 0.0)
+    counted = valid.astype(float)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = filled.sum(axis=0) / counted.sum(axis=0)
+    low = numpy.full(values.shape[1], numpy.nan)
+    high = numpy.full(values.shape[1], numpy.nan)
+    problems = values.shape[0]
+    if resamples <= 0 or problems == 0:
+        return mean, low, high
+    rng = numpy.random.default_rng(seed)
+    means = []
+    for start in range(0, resamples, BOOTSTRAP_CHUNK):
+        size = min(BOOTSTRAP_CHUNK, resamples - start)
+        # How often each problem is drawn in each resample
+        drawn = rng.integers(0, problems, (size, problems)) + numpy.arange(size)[:, None] * problems
+        weights = numpy.bincount(drawn.ravel(), minlength=size * problems).reshape(size, problems).astype(float)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            means.append((weights @ filled) / (weights @ counted))
+    means = numpy.concatenate(means)
+    tail = (1.0 - confidence) / 2 * 100
+    for column in range(values.shape[1]):
+        # Resamples that drew no problem with a value are left out
+        finite = means[:, column][~numpy.isnan(means[:, column])]
+        if len(finite) > 0:
+            low[column], high[column] = numpy.percentile(finite, [tail, 100 - tail])
+    return mean, low, high
+
+
+# pass@k and maj@k for every k in ks, overall and per domain (domains: a
+# label per problem, e.g. the "domain" column of a dataset), each with a
+# bootstrap confidence interval. Returns
+#   {"problems": n, "pass@k": {k: {"mean", "low", "high"}}, "maj@k": {...},
+#    "domains": {domain: {"problems": n, "pass@k": {...}, "maj@k": {...}}}}
+def evaluate(matrix, ks=DEF_KS, domains=None, resamples=DEF_RESAMPLES, confidence=DEF_CONFIDENCE, seed=None):
+    ks = list(ks)
+    metrics = {"pass@k": matrix.pass_at_k(ks), "maj@k": matrix.maj_at_k(ks)}
+    output = _summarize(metrics, ks, numpy.ones(len(matrix.samples), dtype=bool), resamples, confidence, seed)
+    if domains != None:
+        if len(domains) != len(matrix.samples):
+            raise Exception("Number of domains must the same as the number of problems.")
+        labels, inverse = numpy.unique(numpy.asarray([str(domain) for domain in domains]), return_inverse=True)
+        output["domains"] = {
+            str(label): _summarize(metrics, ks, inverse == index, resamples, confidence, seed)
+            for index, label in enumerate(labels)
+        }
+    return output
+
+
+def _summarize(metrics, ks, selected, resamples, confidence, seed):
+    output = {"problems": int(selected.sum())}
+    for name, values in metrics.items():
+        mean, low, high = bootstrap_ci(values[selected], resamples=resamples, confidence=confidence, seed=seed)
+        output[name] = {k: {"mean": _number(mean[i]), "low": _number(low[i]), "high": _number(high[i])} for i, k in enumerate(ks)}
+    return output
+
+
+def _number(value):
+    return None if numpy.isnan(value) else float(value)
@@ -1,49 +1,82 @@
-from .challenger import Challenger
+from .answers import extract_answers
+from .equivalence import equivalent_answers
+from .retry import FailedRequest
+
+# Stored with every grade kept by Storage.grade_experiment; bump it whenever
+# answer extraction or comparison changes, so stored grades are redone
+GRADER_VERSION = 1
+
+# Defaults of Grader.evaluate (see falcon.evaluation)
+DEF_KS = (1,)
+DEF_RESAMPLES = 1000
+DEF_CONFIDENCE = 0.95
 
 class Grader:
+    # Answers are compared with the ground truth in canonical form (see
+    # falcon.equivalence.canonicalize), so "0.5" is accepted for "\frac{1}{2}".
+    # symbolic=True also checks the remaining answers with sympy, in a pool of
+    # `workers` processes (None: one per CPU, 0: in this process).
     @staticmethod
-    def grade(answers_list, answers_ground_truth):
+    def grade(answers_list, answers_ground_truth, symbolic=False, workers=None):
         if len(answers_list) != len(answers_ground_truth):
             raise Exception("Number of answers lists must the same as the number of answers in the ground truth list.")
 
-        output = []
-        index = 0
-        for answers in answers_list:
-            if not isinstance(answers, list):
-                if isinstance(answers, str):
-                    answers = [answers]
-                else:
-                    raise Exception("Each item in answers_list must be a list of answers.")
-            total_count = len(answers)
-            count = 0
-            for ans in answers:
-                if ans == str(answers_ground_truth[index]):
-                    count += 1
-            output.append(count / total_count)
-            index += 1
-
-        return output
+        answers_list = [Grader._answers(answers, "Each item in answers_list must be a list of answers.") for answers in answers_list]
+        return Grader._score(answers_list, answers_ground_truth, symbolic, workers)
 
     @staticmethod
-    def grade_solutions(solutions_list, answers_ground_truth):
+    def grade_solutions(solutions_list, answers_ground_truth, symbolic=False, workers=None):
         if len(solutions_list) != len(answers_ground_truth):
             raise Exception("Number of answers lists must the same as the number of answers in the ground truth list.")
 
-        output = []
-        index = 0
+        answers_list = []
         for solutions in solutions_list:
-            if not isinstance(solutions, list):
-                if isinstance(solutions, str):
-                    solutions = [solutions]
-                else:
-                    raise Exception("Each item in answers_list must be a list of answers or an answer.")
-            answers = Challenger.extract_answers(solutions)
-            total_count = len(answers)
+            solutions = Grader._answers(solutions, "Each item in answers_list must be a list of answers or an answer.")
+            answers_list.append(None if solutions == None else extract_answers(solutions))
+        return Grader._score(answers_list, answers_ground_truth, symbolic, workers)
+
+    # pass@k (unbiased estimator) and maj@k for every k in ks, overall and per
+    # domain when `domains` gives a label per problem, with bootstrap
+    # confidence intervals over the problems; see falcon.evaluation.evaluate
+    # for the output. Needs numpy.
+    @staticmethod
+    def evaluate(answers_list, answers_ground_truth, ks=DEF_KS, domains=None, symbolic=False, workers=None, resamples=DEF_RESAMPLES, confidence=DEF_CONFIDENCE, seed=None):
+        from .evaluation import CorrectnessMatrix, evaluate
+        matrix = CorrectnessMatrix(answers_list, answers_ground_truth, symbolic=symbolic, workers=workers)
+        return evaluate(matrix, ks=ks, domains=domains, resamples=resamples, confidence=confidence, seed=seed)
+
+    @staticmethod
+    def evaluate_solutions(solutions_list, answers_ground_truth, ks=DEF_KS, domains=None, symbolic=False, workers=None, resamples=DEF_RESAMPLES, confidence=DEF_CONFIDENCE, seed=None):
+        from .evaluation import CorrectnessMatrix, evaluate
+        matrix = CorrectnessMatrix.from_solutions(solutions_list, answers_ground_truth, symbolic=symbolic, workers=workers)
+        return evaluate(matrix, ks=ks, domains=domains, resamples=resamples, confidence=confidence, seed=seed)
+
+    # The answers of one problem without its failed requests; None for a
+    # failed problem
+    @staticmethod
+    def _answers(answers, message):
+        # Failed requests are not scored; the problem gets None if nothing is left
+        if isinstance(answers, FailedRequest):
+            return None
+        if not isinstance(answers, list):
+            if isinstance(answers, str):
+                answers = [answers]
+            else:
+                raise Exception(message)
+        return [ans for ans in answers if not isinstance(ans, FailedRequest)]
+
+    @staticmethod
+    def _score(answers_list, answers_ground_truth, symbolic, workers):
+        problems = [(str(truth), answers or []) for answers, truth in zip(answers_list, answers_ground_truth)]
+        matches = equivalent_answers(problems, symbolic=symbolic, workers=workers)
+        output = []
+        for answers, correct in zip(answers_list, matches):
+            if answers == None or len(answers) == 0:
+                output.append(None)
+                continue
             count = 0
             for ans in answers:
-                if ans == str(answers_ground_truth[index]):
+                if ans in correct:
                     count += 1
-            output.append(count / total_count)
-            index += 1
-
-        return output
\ No newline at end of file
+            output.append(count / len(answers))
+        return output
@@ -0,0 +1,54 @@
+import threading
+from collections import deque
+
+# Number of recent latencies the percentile is computed over
+WINDOW = 512
+
+
+class HedgePolicy:
+    # Decides when a slow call gets a duplicate: once it has been running for
+    # longer than `percentile` of the recently observed latencies. Nothing is
+    # hedged until min_samples latencies were seen, and at most max_ratio of
+    # the calls are duplicated so a slow provider is not flooded.
+    def __init__(self, percentile=95, min_samples=20, max_ratio=0.1, min_delay=0.0, window=WINDOW):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.min_delay = min_delay
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.threshold = None
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def record(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self.threshold = None
+
+    # Seconds to wait before hedging a new call, or None to not hedge it
+    def delay(self):
+        with self.lock:
+            self.calls += 1
+            if len(self.samples) < self.min_samples:
+                return None
+            if self.threshold == None:
+                ordered = sorted(self.samples)
+                self.threshold = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+            return max(self.threshold, self.min_delay)
+
+    def allow(self):
+        with self.lock:
+            if self.hedges >= self.max_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        with self.lock:
+            self.wins += 1
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "hedges": self.hedges, "wins": self.wins, "samples": len(self.samples)}
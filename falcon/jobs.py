@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .retry import FailedRequest, classify, FATAL
+
+DEF_REGISTRY_PATH = os.path.join(".falcon_cache", "jobs.json")
+# Seconds between polls of a job; doubled (up to the maximum) after every poll
+# that finds it still running
+DEF_POLL_INTERVAL = 30
+DEF_MAX_POLL_INTERVAL = 600
+# Jobs polled (and downloaded) at the same time
+DEF_POLL_WORKERS = 8
+
+# Job statuses
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class JobManager:
+    # Tracks batch jobs (send_problems / retrieve_problems) in a local JSON
+    # registry, so that a job's parameters survive the process that submitted
+    # it. Pending jobs are polled concurrently with exponential backoff and
+    # their results are downloaded, voted on and stored next to the registry
+    # as soon as each one finishes.
+    def __init__(self, path=DEF_REGISTRY_PATH, poll_interval=DEF_POLL_INTERVAL, max_poll_interval=DEF_MAX_POLL_INTERVAL, max_workers=DEF_POLL_WORKERS):
+        self.path = path
+        self.results_directory = os.path.splitext(path)[0]
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.challengers = {}
+        # {job id: (monotonic time of the next poll, current interval)}
+        self.schedule = {}
+
+        os.makedirs(self.results_directory, exist_ok=True)
+        self.registry = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.registry = json.load(file)
+
+    # Sends the problems as a batch through the challenger and registers the job
+    def submit(self, challenger, problems, hints=None, voters=1, output_type='solutions', vote=True, name=None):
+        if output_type != 'solutions' and output_type != 'answers':
+            raise Exception("Output type must be either 'solutions' or 'answers'")
+        batch_id = challenger.send_problems(problems, hints=hints, voters=voters)
+        if batch_id == None:
+            raise Exception("The pipe '" + challenger.get_pipe() + "' did not return a batch id")
+        return self.track(challenger, batch_id, len(problems), voters=voters, output_type=output_type, vote=vote, name=name)
+
+    # Registers a batch that was already sent
+    def track(self, challenger, batch_id, count, voters=1, output_type='solutions', vote=True, name=None):
+        job_id = uuid.uuid4().hex[:16]
+        with self.lock:
+            self.registry[job_id] = {
+                "name": name,
+                "pipe": challenger.get_pipe(),
+                "model": challenger.get_model(),
+                "temperature": challenger.get_temperature(),
+                "batch_id": batch_id,
+                "count": count,
+                "voters": voters,
+                "output_type": output_type,
+                "vote": vote,
+                "status": RUNNING,
+                "error": None,
+                "created": time.time(),
+                "finished": None
+            }
+            self._save()
+        return job_id
+
+    def jobs(self, status=None):
+        with self.lock:
+            return [job_id for job_id, job in self.registry.items() if status == None or job["status"] == status]
+
+    def get(self, job_id):
+        with self.lock:
+            return dict(self.registry[job_id])
+
+    def status(self, job_id):
+        return self.get(job_id)["status"]
+
+    # Results of a completed job (None otherwise); unanswered problems are
+    # FailedRequest records
+    def results(self, job_id):
+        if self.status(job_id) != COMPLETED:
+            return None
+        with open(self._results_path(job_id), "r", encoding="utf-8") as file:
+            return [_decode(res) for res in json.load(file)]
+
+    def forget(self, job_id):
+        with self.lock:
+            del self.registry[job_id]
+            self.schedule.pop(job_id, None)
+            self._save()
+        if os.path.exists(self._results_path(job_id)):
+            os.remove(self._results_path(job_id))
+
+    # One round of polling: every running job that is due is polled
+    # concurrently. Returns the ids of the jobs that finished.
+    def poll(self, job_ids=None):
+        due = self._due(job_ids if job_ids != None else self.jobs(RUNNING))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return [job_id for job_id, finished in executor.map(lambda job_id: (job_id, self._poll(job_id)), due) if finished]
+
+    # Yields (job id, results) as jobs finish, in completion order. Failed
+    # jobs yield None (see get(job_id)["error"]). Raises TimeoutError if jobs
+    # are still running after `timeout` seconds.
+    def as_completed(self, job_ids=None, timeout=None):
+        end = None if timeout == None else time.monotonic() + timeout
+        pending = set(job_ids if job_ids != None else self.jobs(RUNNING))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                for job_id in list(pending):
+                    if self.status(job_id) != RUNNING:
+                        pending.discard(job_id)
+                        yield job_id, self.results(job_id)
+                if len(pending) == 0:
+                    return
+                polls = {executor.submit(self._poll, job_id): job_id for job_id in self._due(pending)}
+                for future in as_completed(polls):
+                    job_id = polls[future]
+                    if future.result():
+                        pending.discard(job_id)
+                        yield job_id, self.results(job_id)
+                if len(pending) == 0:
+                    return
+                wait = min(self.schedule[job_id][0] for job_id in pending) - time.monotonic()
+                if end != None and time.monotonic() + max(wait, 0) > end:
+                    raise TimeoutError(f"{len(pending)} jobs are still running")
+                if wait > 0:
+                    time.sleep(wait)
+
+    # Waits for the jobs and returns {job id: results} of those that finished
+    # (all of them unless the timeout expired first)
+    def wait(self, job_ids=None, timeout=None):
+        finished = {}
+        try:
+            for job_id, results in self.as_completed(job_ids, timeout=timeout):
+                finished[job_id] = results
+        except TimeoutError:
+            pass
+        return finished
+
+    def _due(self, job_ids):
+        now = time.monotonic()
+        with self.lock:
+            for job_id in job_ids:
+                self.schedule.setdefault(job_id, (now, self.poll_interval))
+            return [job_id for job_id in job_ids if self.schedule[job_id][0] <= now]
+
+    # Returns True once the job has finished (completed or failed)
+    def _poll(self, job_id):
+        job = self.get(job_id)
+        try:
+            results = self._challenger(job).retrieve_problems(job["batch_id"], output_type=job["output_type"], vote=job["vote"])
+        except Exception as e:
+            if classify(e) == FATAL:
+                self._finish(job_id, FAILED, error=f"{type(e).__name__}: {e}")
+                return True
+            self._backoff(job_id)
+            return False
+        if results == None:
+            self._backoff(job_id)
+            return False
+        with open(self._results_path(job_id), "w", encoding="utf-8") as file:
+            json.dump([_encode(res) for res in results], file)
+        self._finish(job_id, COMPLETED)
+        return True
+
+    def _backoff(self, job_id):
+        with self.lock:
+            _, interval = self.schedule[job_id]
+            # Jitter spreads the polls of jobs submitted together
+            self.schedule[job_id] = (time.monotonic() + interval * random.uniform(0.8, 1.2), min(interval * 2, self.max_poll_interval))
+
+    def _finish(self, job_id, status, error=None):
+        with self.lock:
+            self.registry[job_id]["status"] = status
+            self.registry[job_id]["error"] = error
+            self.registry[job_id]["finished"] = time.time()
+            self._save()
+
+    def _challenger(self, job):
+        # Imported here so that the manager can be loaded without a pipe
+        from .challenger import Challenger
+        key = (job["pipe"], job["model"])
+        with self.lock:
+            if key not in self.challengers:
+                self.challengers[key] = Challenger(job["pipe"], model=job["model"], temperature=job["temperature"])
+            return self.challengers[key]
+
+    def _results_path(self, job_id):
+        return os.path.join(self.results_directory, job_id + ".json")
+
+    def _save(self):
+        # Written to a temporary file first so a crash never truncates the registry
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(self.registry, file, indent=1)
+        os.replace(temporary, self.path)
+
+
+def _encode(res):
+    if isinstance(res, FailedRequest):
+        return {"reason": res.reason, "error_type": res.error_type, "error": res.error, "attempts": res.attempts}
+    return res
+
+def _decode(res):
+    if not isinstance(res, dict):
+        return res
+    failure = FailedRequest(res["reason"], attempts=res["attempts"])
+    failure.error_type = res["error_type"]
+    failure.error = res["error"]
+    return failure
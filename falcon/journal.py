@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import threading
+from .cache import ResponseCache
+
+# fsync after this many records or this many seconds, whichever comes first
+FSYNC_EVERY = 64
+FSYNC_INTERVAL = 1.0
+
+
+class Journal:
+    # Append-only JSONL checkpoint of a sync run. Every completed response is
+    # written as {"key", "voter", "response"}, where key identifies the pipe,
+    # request parameters, compiled prompt and voter (as in ResponseCache), so
+    # a resumed run skips exactly the work that already finished even if the
+    # problems are reordered. A torn last line from a crash is ignored.
+    def __init__(self, path, fsync_every=FSYNC_EVERY, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.resumed = 0
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "rb+") as file:
+            data = file.read()
+            # Drop a torn last line so new records start on a fresh line
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                file.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self.entries[record["key"]] = record["response"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Same interface as ResponseCache
+    def get_many(self, namespace, prompt, voters, params):
+        found = {}
+        with self.lock:
+            for voter in voters:
+                key = ResponseCache.key(namespace, prompt, voter, params)
+                if key in self.entries:
+                    found[voter] = self.entries[key]
+            self.resumed += len(found)
+        return found
+
+    def put_many(self, namespace, prompt, responses, params):
+        with self.lock:
+            for voter, response in responses.items():
+                if not isinstance(response, str):
+                    continue
+                key = ResponseCache.key(namespace, prompt, voter, params)
+                self.entries[key] = response
+                self.file.write(json.dumps({"key": key, "voter": voter, "response": response}) + "\n")
+                self.unsynced += 1
+            if self.unsynced >= self.fsync_every or time.monotonic() - self.synced_at >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._sync()
+                self.file.close()
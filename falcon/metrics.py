@@ -0,0 +1,213 @@
+import json
+import time
+import threading
+from .usage import get_usage
+
+# Upper bounds (seconds) of the histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.9, 0.99)
+
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+
+
+class Histogram:
+    # Fixed-bucket histogram; quantiles are interpolated within a bucket.
+    # Not locked itself: PipeMetrics holds its lock around every call.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count > 0 and seen + count >= rank:
+                lower = 0 if index == 0 else self.buckets[index - 1]
+                if index == len(self.buckets):
+                    # +Inf bucket: report its lower bound
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        stats = {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count > 0 else None
+        }
+        for q in QUANTILES:
+            stats[f"p{int(q * 100)}"] = self.quantile(q)
+        cumulative = 0
+        stats["buckets"] = []
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            cumulative += count
+            stats["buckets"].append((bound, cumulative))
+        return stats
+
+
+class PipeMetrics:
+    # Counters and histograms of the calls the schedulers make to one pipe:
+    # every attempt is a request; its latency covers the pipe call only,
+    # queue_wait the time spent waiting for the provider budget and the rate
+    # limiter beforehand.
+    def __init__(self, pipename):
+        self.pipename = pipename
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.in_flight = 0
+            self.errors = {}
+            self.retries = 0
+            self.failures = {}
+            self.latency = Histogram(LATENCY_BUCKETS)
+            self.queue_wait = Histogram(QUEUE_WAIT_BUCKETS)
+            self.started = None
+
+    def record_start(self, queue_wait):
+        with self.lock:
+            if self.started == None:
+                self.started = time.monotonic()
+            self.requests += 1
+            self.in_flight += 1
+            self.queue_wait.observe(queue_wait)
+
+    # kind: None for a success, the error class (see retry.classify) otherwise
+    def record_end(self, latency, kind=None):
+        with self.lock:
+            self.in_flight -= 1
+            self.latency.observe(latency)
+            if kind != None:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_failure(self, reason):
+        with self.lock:
+            self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def snapshot(self):
+        # Token counts are those the pipe reported (see falcon.usage)
+        usage = get_usage(self.pipename)
+        with self.lock:
+            elapsed = None if self.started == None else time.monotonic() - self.started
+            tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+            return {
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "errors": dict(self.errors),
+                "retries": self.retries,
+                "failures": dict(self.failures),
+                "latency": self.latency.snapshot(),
+                "queue_wait": self.queue_wait.snapshot(),
+                "usage": usage,
+                "elapsed": elapsed,
+                "requests_per_second": self.requests / elapsed if elapsed else None,
+                "tokens_per_second": tokens / elapsed if elapsed else None
+            }
+
+
+def get_metrics(pipename):
+    with _METRICS_LOCK:
+        if pipename not in _METRICS:
+            _METRICS[pipename] = PipeMetrics(pipename)
+        return _METRICS[pipename]
+
+
+# {pipe name: metrics} of every pipe used by this process (or of one pipe)
+def metrics_snapshot(pipename=None):
+    with _METRICS_LOCK:
+        selected = [metrics for name, metrics in _METRICS.items() if pipename == None or name == pipename]
+    return {metrics.pipename: metrics.snapshot() for metrics in selected}
+
+
+def metrics_json(pipename=None, indent=None):
+    return json.dumps(metrics_snapshot(pipename), indent=indent)
+
+
+# Prometheus text exposition format (version 0.0.4), one series per pipe
+def metrics_prometheus(pipename=None):
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def sample(name, labels, value):
+        label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {_number(value)}")
+
+    snapshot = metrics_snapshot(pipename)
+    counters = [
+        ("falcon_requests_total", "Pipe calls made by the schedulers, retries included", lambda stats: stats["requests"]),
+        ("falcon_retries_total", "Attempts that were retried", lambda stats: stats["retries"]),
+        ("falcon_prompt_tokens_total", "Prompt tokens reported by the pipe", lambda stats: stats["usage"]["prompt_tokens"]),
+        ("falcon_cached_tokens_total", "Prompt tokens served from the provider's prefix cache", lambda stats: stats["usage"]["cached_tokens"]),
+        ("falcon_completion_tokens_total", "Completion tokens reported by the pipe", lambda stats: stats["usage"]["completion_tokens"])
+    ]
+    for name, help_text, value in counters:
+        family(name, "counter", help_text)
+        for pipe, stats in snapshot.items():
+            sample(name, {"pipe": pipe}, value(stats))
+
+    family("falcon_in_flight_requests", "gauge", "Pipe calls in progress")
+    for pipe, stats in snapshot.items():
+        sample("falcon_in_flight_requests", {"pipe": pipe}, stats["in_flight"])
+
+    labelled = [
+        ("falcon_errors_total", "Failed pipe calls by error class", "errors", "kind"),
+        ("falcon_failed_requests_total", "Prompts given up on, by reason", "failures", "reason"),
+        ("falcon_finish_reasons_total", "Responses by finish reason", "finish_reasons", "reason")
+    ]
+    for name, help_text, field, label in labelled:
+        family(name, "counter", help_text)
+        for pipe, stats in snapshot.items():
+            counts = stats["usage"][field] if field == "finish_reasons" else stats[field]
+            for key, count in sorted(counts.items()):
+                sample(name, {"pipe": pipe, label: key}, count)
+
+    histograms = [
+        ("falcon_request_latency_seconds", "Latency of the pipe calls", "latency"),
+        ("falcon_queue_wait_seconds", "Time waited for the provider budget and rate limiter", "queue_wait")
+    ]
+    for name, help_text, field in histograms:
+        family(name, "histogram", help_text)
+        for pipe, stats in snapshot.items():
+            for bound, count in stats[field]["buckets"]:
+                sample(name + "_bucket", {"pipe": pipe, "le": bound}, count)
+            sample(name + "_sum", {"pipe": pipe}, stats[field]["sum"])
+            sample(name + "_count", {"pipe": pipe}, stats[field]["count"])
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    with _METRICS_LOCK:
+        for metrics in _METRICS.values():
+            metrics.reset()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -4,7 +4,10 @@ DEF_MODEL = "None"
 DEF_TEMPERATURE = 0
 
 
-def retrieve_response(prompt, system_prompt=None, model=None, temperature=None, response_count=None, max_tokens=None):
+def retrieve_response(prompt, system_prompt=None, model=None, temperature=None, response_count=None, max_tokens=None, timeout=None):
+    raise Exception(ERR_MSG)
+
+async def aretrieve_response(prompt, system_prompt=None, model=None, temperature=None, response_count=None, max_tokens=None, timeout=None):
     raise Exception(ERR_MSG)
 
 def send_batch(prompts, system_prompts=None, model=None, temperature=None, response_count=None, max_tokens=None):
@@ -1,18 +1,91 @@
 #
 # External Imports
 import os
-import openai
-import random
 import json
-import string
+import logging
+import threading
+from ..retry import FailedRequest
+from ..usage import record_usage, claim_batch_usage
+from .messages import build_messages
+from .streaming import read_stream, aread_stream, DEF_ANSWER_GRACE
+
+logger = logging.getLogger(__name__)
 
 
 
 #
 # API Key Setup
-# Use this section to set up your model authentication
-API_KEY = os.environ['OPENAI_API_KEY']
-openai.api_key = API_KEY
+# Use this section to set up your model authentication. The key is read
+# when the first client is built, so importing the pipe needs no key.
+API_KEY = None
+
+def _api_key():
+    global API_KEY
+    if API_KEY == None:
+        API_KEY = os.environ['OPENAI_API_KEY']
+    return API_KEY
+
+
+
+#
+# Client Setup
+# One client per set of connection options (pool size, keep-alive, HTTP/2),
+# built on first use and shared by every caller asking for those options;
+# clients are never closed while the pipe is loaded, since other callers may
+# have requests in flight on them. configure_client(...) sets the options
+# used by calls that do not pass client_options themselves.
+clients = {}
+async_clients = {}
+# Async connections belong to the event loop that opened them
+async_client_loop = None
+client_options = {"max_connections": None, "keepalive_expiry": None, "http2": False}
+client_lock = threading.Lock()
+
+def configure_client(max_connections=None, keepalive_expiry=None, http2=False):
+    global client_options
+    options = {"max_connections": max_connections, "keepalive_expiry": keepalive_expiry, "http2": http2}
+    with client_lock:
+        if options != client_options:
+            client_options = options
+
+def _options_key(options):
+    options = client_options if options == None else options
+    return (options.get("max_connections"), options.get("keepalive_expiry"), bool(options.get("http2")))
+
+def _http_client(client_class, key):
+    max_connections, keepalive_expiry, http2 = key
+    if max_connections == None and not http2:
+        return None
+    import httpx
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry
+    )
+    return client_class(limits=limits, http2=http2)
+
+def _get_client(options=None):
+    key = _options_key(options)
+    with client_lock:
+        if key not in clients:
+            # openai (and httpx) are imported with the first client
+            import openai
+            clients[key] = openai.OpenAI(api_key=_api_key(), http_client=_http_client(openai.DefaultHttpxClient, key))
+        return clients[key]
+
+def _get_async_client(options=None):
+    import asyncio
+    global async_clients, async_client_loop
+    loop = asyncio.get_running_loop()
+    key = _options_key(options)
+    with client_lock:
+        if async_client_loop is not loop:
+            async_clients = {}
+            async_client_loop = loop
+        if key not in async_clients:
+            import openai
+            async_clients[key] = openai.AsyncOpenAI(api_key=_api_key(), http_client=_http_client(openai.DefaultAsyncHttpxClient, key))
+        return async_clients[key]
 
 
 
@@ -21,10 +94,41 @@ openai.api_key = API_KEY
 # Set up the default values used for communication
 DEF_SYSTEM_PROMPT = None
 DEF_MODEL = "gpt-4o-mini"
+# Name the token usage of the pipe is recorded under (see falcon.usage)
+PIPE_NAME = "OpenAI"
 DEF_TEMPERATURE = 0
 DEF_RESPONSE_COUNT = 1
 DEF_MAX_TOKENS = None
 
+# Most choices a single request may ask for (the "n" parameter). Responses
+# beyond it are requested in further chunks.
+MAX_CHOICES = 128
+
+# retrieve_response(...) accepts stop_on_answer: the response is streamed and
+# ended shortly after its \boxed{} answer (see pipelines/streaming.py)
+SUPPORTS_STOP_ON_ANSWER = True
+# retrieve_response(...) accepts client_options: the connection options
+# ({"max_connections", "keepalive_expiry", "http2"}) of the client to use
+SUPPORTS_CLIENT_OPTIONS = True
+# Usage is sent in a last chunk, received only by streams read to the end
+STREAM_PARAMS = {"stream": True, "stream_options": {"include_usage": True}}
+
+# Batch API limits of a single input file (the size with some headroom).
+# Larger jobs are split into several batches ("shards").
+MAX_BATCH_REQUESTS = 50000
+MAX_BATCH_BYTES = 190 * 1024 * 1024
+# Shards uploaded at the same time
+BATCH_UPLOAD_WORKERS = 4
+# A sharded job is identified by the ids of its batches joined by this
+BATCH_ID_SEPARATOR = ","
+# Statuses after which a batch does not change any more
+BATCH_DONE_STATUSES = {"completed", "expired", "cancelled", "failed"}
+# Seconds a batch may take to complete (its completion window)
+BATCH_WINDOW = 24 * 3600
+# Reasons recorded on the FailedRequest of an unanswered batch item
+REASON_BATCH_ERROR = "batch_error"
+REASON_BATCH_INCOMPLETE = "batch_incomplete"
+
 
 
 #
@@ -36,38 +140,56 @@ DEF_MAX_TOKENS = None
 #       temperature:    (float) the model temperature, if applicable
 #       response_count  (integer) the number of responses to generate
 #       max_tokens      (integer) the maximum number of tokens in the response
+#       timeout         (float) seconds before the request is abandoned, if applicable
+#       stop_on_answer  (boolean) end each response answer_grace characters after its \boxed{} answer
+#       client_options  (dict) connection options of the client to use (see configure_client)
 #
 # OUTPUT:
 # The funtion should output an array of all generated 
 # responses, stored as strings
-def retrieve_response(prompt, system_prompt=DEF_SYSTEM_PROMPT, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS):
-    messages = [{"role": "user", "content": prompt}]
-    print(0)
-    if system_prompt != None:
-        messages.append({"role": "system", "content": system_prompt})
+def retrieve_response(prompt, system_prompt=DEF_SYSTEM_PROMPT, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None, stop_on_answer=False, answer_grace=DEF_ANSWER_GRACE, client_options=None):
+    messages = build_messages(prompt, system_prompt)
 
     responses = []
 
-    for i in range(response_count):
-        response = None
-        if max_tokens == None:
-            response = openai.chat.completions.create(
-                model=model, 
-                messages=messages,
-                temperature=temperature
-            )
+    for n in _choice_chunks(response_count):
+        logger.debug("Requesting %d responses from %s for prompt %r", n, model, prompt)
+        params = _completion_params(model, messages, temperature, max_tokens, n, timeout)
+        if stop_on_answer:
+            stream = _get_client(client_options).chat.completions.create(**params, **STREAM_PARAMS)
+            texts, reasons, usage, stream_model = read_stream(stream, n, stop_on_answer=True, grace=answer_grace)
+            record_usage(PIPE_NAME, stream_model or model, usage, reasons)
+            responses += texts
+            continue
+        response = _get_client(client_options).chat.completions.create(**params)
+        record_usage(PIPE_NAME, response.model, response.usage, [choice.finish_reason for choice in response.choices])
+        responses += [choice.message.content for choice in response.choices]
+        
+    return responses
+
 
-        else:
-            response = openai.chat.completions.create(
-                model=model, 
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
 
+#
+# Optional: implement aretrieve_response(...) as a coroutine with the same
+# parameters and output as retrieve_response(...). When present it is used by
+# the async scheduler, so many requests can share a single event loop.
+async def aretrieve_response(prompt, system_prompt=DEF_SYSTEM_PROMPT, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None, stop_on_answer=False, answer_grace=DEF_ANSWER_GRACE, client_options=None):
+    messages = build_messages(prompt, system_prompt)
+
+    responses = []
+
+    for n in _choice_chunks(response_count):
+        params = _completion_params(model, messages, temperature, max_tokens, n, timeout)
+        if stop_on_answer:
+            stream = await _get_async_client(client_options).chat.completions.create(**params, **STREAM_PARAMS)
+            texts, reasons, usage, stream_model = await aread_stream(stream, n, stop_on_answer=True, grace=answer_grace)
+            record_usage(PIPE_NAME, stream_model or model, usage, reasons)
+            responses += texts
+            continue
+        response = await _get_async_client(client_options).chat.completions.create(**params)
+        record_usage(PIPE_NAME, response.model, response.usage, [choice.finish_reason for choice in response.choices])
+        responses += [choice.message.content for choice in response.choices]
 
-        responses.append(response.choices[0].message.content)
-        
     return responses
 
 
@@ -80,43 +202,107 @@ def retrieve_response(prompt, system_prompt=DEF_SYSTEM_PROMPT, model=DEF_MODEL,
 #       temperature:    (float) the model temperature, if applicable
 #       response_count  (integer) the number of responses per question to generate
 #       max_tokens      (integer) the maximum number of tokens per response
+#       max_requests    (integer) the most requests per batch input file
+#       max_bytes       (integer) the largest batch input file, in bytes
 #
 # OUTPUT:
-# The function should output the batch id
-def send_batch(prompts, system_prompts=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS):
-    tasks = []
-    index = 0
+# The function should output the batch id. Jobs over the limits are sent as
+# several batches whose ids are joined by BATCH_ID_SEPARATOR.
+def send_batch(prompts, system_prompts=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    if len(prompts) == 0:
+        raise Exception("There must be at least one prompt in a batch")
+    lines = _batch_lines(prompts, system_prompts, model, temperature, response_count, max_tokens)
+    return BATCH_ID_SEPARATOR.join(_submit_lines(lines, max_requests, max_bytes))
+
+# Uploads the JSONL lines as one or more batches and returns their ids
+def _submit_lines(lines, max_requests, max_bytes):
+    # Imported here, like tempfile: only batch jobs need them
+    from concurrent.futures import ThreadPoolExecutor
+    # Each shard is uploaded as soon as it is written
+    executor = ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS)
+    uploads = []
+    try:
+        for path in _write_shards(lines, max_requests, max_bytes):
+            uploads.append(executor.submit(_upload_shard, path))
+        executor.shutdown(wait=True)
+        batch_ids = [upload.result() for upload in uploads]
+    except BaseException:
+        executor.shutdown(wait=True)
+        # A partially submitted job can never be retrieved
+        _cancel_batches([upload.result() for upload in uploads if upload.done() and upload.exception() == None])
+        raise
+    return batch_ids
+
+def _batch_lines(prompts, system_prompts, model, temperature, response_count, max_tokens):
     total_count = len(prompts)
+    for index, prompt in enumerate(prompts):
+        system_prompt = None if system_prompts == None else system_prompts[index]
+        for obj in _generate_prompts_json(prompt, system_prompt, index, total_count, max_tokens=max_tokens, temperature=temperature, model=model, compute_count=response_count):
+            yield json.dumps(obj)
+
+# Writes the lines to temporary JSONL files of at most max_requests lines and
+# max_bytes bytes, yielding each path once the file is complete. The caller
+# owns (and must delete) every yielded file.
+def _write_shards(lines, max_requests, max_bytes):
+    import tempfile
+    file = None
+    try:
+        for line in lines:
+            data = (line + "\n").encode("utf-8")
+            if file != None and (count >= max_requests or size + len(data) > max_bytes):
+                file.close()
+                yield path
+                file = None
+            if file == None:
+                descriptor, path = tempfile.mkstemp(prefix="falcon-batch-", suffix=".jsonl")
+                file = os.fdopen(descriptor, "wb")
+                count = 0
+                size = 0
+            file.write(data)
+            count += 1
+            size += len(data)
+        if file != None:
+            file.close()
+            yield path
+            file = None
+    finally:
+        if file != None:
+            file.close()
+            os.remove(path)
+
+def _upload_shard(path):
+    try:
+        with open(path, "rb") as file:
+            batch_file = _get_client().files.create(file=file, purpose="batch")
+    finally:
+        os.remove(path)
+
+    try:
+        batch_job = _get_client().batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=f"{BATCH_WINDOW // 3600}h"
+        )
+    except BaseException:
+        # No batch will ever use (or clean up) the uploaded file
+        try:
+            _get_client().files.delete(batch_file.id)
+        except Exception:
+            pass
+        raise
+    return batch_job.id
 
-    for prompt in prompts:
-        system_prompt = "" if system_prompts == None else system_prompts[index]
-        if max_tokens == None:
-            tasks += _generate_prompts_json(prompt, system_prompt, index, total_count, temperature=temperature, model=model, compute_count=response_count)
-        else:
-            tasks += _generate_prompts_json(prompt, system_prompt, index, total_count, max_tokens=max_tokens, temperature=temperature, model=model, compute_count=response_count)
-        index += 1
-    
-    filename = "./file-" + (''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(24))) + ".jsonl"
-
-    file = open(filename, "w")
-
-    for obj in tasks:
-        file.write(json.dumps(obj) + "\n")
-
-    file.close()
-
-    batch_file = openai.files.create(
-        file=open(filename, "rb"),
-        purpose="batch"
-    )
-
-    batch_job = openai.batches.create(
-        input_file_id=batch_file.id,
-        endpoint="/v1/chat/completions",
-        completion_window="24h"
-    )
+# Optional: stops every shard of a running job. Requests already processed
+# stay in the results of retrieve_batch(...).
+def cancel_batch(batch_id):
+    _cancel_batches(batch_id.split(BATCH_ID_SEPARATOR))
 
-    return batch_job.id
+def _cancel_batches(batch_ids):
+    for batch_id in batch_ids:
+        try:
+            _get_client().batches.cancel(batch_id)
+        except Exception:
+            pass
 
 
 
@@ -128,83 +314,183 @@ def send_batch(prompts, system_prompts=None, model=DEF_MODEL, temperature=DEF_TE
 # The function should output an array of string array, each containing 
 # all responses for each question. The string arrays in the main array must be
 # in the same order in which the questions were parsed to the model in send_batch(...)
+#
+# None is returned while any shard is still running. Once every shard has
+# finished (even as expired, cancelled or failed), questions that were not
+# fully answered are FailedRequest records with reason REASON_BATCH_ERROR
+# (the error of the request) or REASON_BATCH_INCOMPLETE (never processed).
 def retrieve_batch(batch_id):
-    res = openai.batches.retrieve(batch_id)
-
-    if (res.status != "completed"):
+    jobs = _finished_jobs(batch_id)
+    if jobs == None:
         return None
-
-    output_file_id = res.output_file_id
-    output_file = openai.files.content(output_file_id).text
-    output_lines = output_file.splitlines()
+    chunks, chunk_counts, errors, total_count = _read_results(jobs)
+    if total_count == None:
+        total_count = _request_count(jobs)
+    incomplete = ", ".join(sorted(set(job.status for job in jobs if job.status != "completed")))
 
     output = []
-
-    id_init = json.loads(output_lines[0].strip())['custom_id']
-    blocks_init = id_init.split("-")
-
-    if len(blocks_init) != 4:
-        return None
-
-    total_count = int(blocks_init[3])
-
-    for i in range(total_count):
-        output.append([])
-    
-    for line in output_lines:
-        obj = json.loads(line.strip())
-        blocks = obj['custom_id'].split("-")
-
-        if len(blocks) == 4:
-            current_index = int(blocks[2])
-            result = obj['response']['body']['choices'][0]['message']['content']
-            output[current_index].append(result)
-
+    for index in range(total_count):
+        responses = chunks.get(index, {})
+        if index in chunk_counts and len(responses) == chunk_counts[index]:
+            output.append([response for chunk in sorted(responses) for response in responses[chunk]])
+        elif index in errors:
+            output.append(FailedRequest(REASON_BATCH_ERROR, Exception(errors[index])))
+        else:
+            output.append(FailedRequest(REASON_BATCH_INCOMPLETE, Exception("batch " + (incomplete or "completed"))))
     return output
 
+# Optional: sends the requests of a finished job that did not succeed as new
+# batches. Returns the id of the whole job (the old and the new shards), to be
+# passed to retrieve_batch(...), which takes every answer from whichever shard
+# has it.
+def resubmit_batch(batch_id, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+    jobs = _finished_jobs(batch_id)
+    if jobs == None:
+        raise Exception("The batch must have finished before it is resubmitted")
+    answered = set()
+    for job in jobs:
+        for obj in _stream_jsonl(job.output_file_id):
+            if _succeeded(obj):
+                answered.add(obj['custom_id'])
+    lines = (json.dumps(obj) for obj in _read_requests(jobs) if obj['custom_id'] not in answered)
+    batch_ids = _submit_lines(lines, max_requests, max_bytes)
+    return BATCH_ID_SEPARATOR.join([batch_id] + batch_ids)
+
+# Optional: the questions of a finished job that retrieve_batch(...) returned
+# as failed, so that they can be sent again through retrieve_response(...).
+# Each is {"index", "prompt", "system_prompt", "model", "temperature",
+# "max_tokens", "response_count"}.
+def failed_requests(batch_id, output):
+    jobs = _finished_jobs(batch_id)
+    if jobs == None:
+        return []
+    failed = set(index for index, res in enumerate(output) if isinstance(res, FailedRequest))
+    requests = {}
+    for obj in _read_requests(jobs):
+        _, _, index, _ = _parse_custom_id(obj['custom_id'])
+        if index not in failed:
+            continue
+        body = obj['body']
+        messages = {message['role']: message['content'] for message in body['messages']}
+        if index not in requests:
+            requests[index] = {
+                "index": index,
+                "prompt": messages.get('user'),
+                "system_prompt": messages.get('system') or None,
+                "model": body.get('model'),
+                "temperature": body.get('temperature'),
+                "max_tokens": body.get('max_tokens'),
+                "response_count": 0
+            }
+        requests[index]["response_count"] += body.get('n', 1)
+    return [requests[index] for index in sorted(requests)]
+
+def _finished_jobs(batch_id):
+    jobs = [_get_client().batches.retrieve(shard_id) for shard_id in batch_id.split(BATCH_ID_SEPARATOR)]
+    for job in jobs:
+        if job.status not in BATCH_DONE_STATUSES:
+            return None
+    return jobs
+
+def _read_results(jobs):
+    # {prompt index: {chunk: responses}}, {prompt index: chunk count},
+    # {prompt index: error message} and the prompt count. Lines may come in
+    # any order; a success in any shard overrides errors in the others.
+    chunks = {}
+    chunk_counts = {}
+    errors = {}
+    total_count = None
+    for job in jobs:
+        # Shards are counted once, also when they are part of a resubmitted job
+        record = claim_batch_usage(PIPE_NAME, job.id)
+        for obj in _stream_jsonl(job.output_file_id):
+            chunk, chunk_count, index, total_count = _parse_custom_id(obj['custom_id'])
+            chunk_counts[index] = chunk_count
+            if _succeeded(obj):
+                body = obj['response']['body']
+                chunks.setdefault(index, {})[chunk] = [choice['message']['content'] for choice in body['choices']]
+                if record:
+                    record_usage(PIPE_NAME, body.get('model'), body.get('usage'), [choice.get('finish_reason') for choice in body['choices']])
+            else:
+                errors[index] = _error_message(obj)
+        for obj in _stream_jsonl(job.error_file_id):
+            _, chunk_count, index, total_count = _parse_custom_id(obj['custom_id'])
+            chunk_counts[index] = chunk_count
+            errors[index] = _error_message(obj)
+    return chunks, chunk_counts, errors, total_count
+
+def _request_count(jobs):
+    # Nothing was answered: the prompt count is read from the first request
+    for obj in _read_requests(jobs[:1]):
+        return _parse_custom_id(obj['custom_id'])[3]
+    return 0
+
+def _read_requests(jobs):
+    seen = set()
+    for job in jobs:
+        for obj in _stream_jsonl(job.input_file_id):
+            if obj['custom_id'] not in seen:
+                seen.add(obj['custom_id'])
+                yield obj
+
+def _stream_jsonl(file_id):
+    if file_id == None:
+        return
+    with _get_client().files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line.strip() != "":
+                yield json.loads(line)
+
+# custom_id is "{chunk}-{chunk count}-{prompt index}-{prompt count}"
+def _parse_custom_id(custom_id):
+    return tuple(int(block) for block in custom_id.split("-"))
+
+def _succeeded(obj):
+    response = obj.get('response')
+    return obj.get('error') == None and response != None and response.get('status_code') == 200
+
+def _error_message(obj):
+    error = obj.get('error')
+    if error == None and obj.get('response') != None:
+        error = obj['response'].get('body', {}).get('error')
+    if isinstance(error, dict):
+        return error.get('message') or error.get('code') or json.dumps(error)
+    return str(error)
+
+def _choice_chunks(response_count):
+    chunks = []
+    while response_count > 0:
+        chunks.append(min(response_count, MAX_CHOICES))
+        response_count -= chunks[-1]
+    return chunks
+
+def _completion_params(model, messages, temperature, max_tokens, n, timeout=None):
+    params = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature
+    }
+    if max_tokens != None:
+        params["max_tokens"] = max_tokens
+    if n > 1:
+        params["n"] = n
+    # Per-request timeout (seconds), enforced by the openai client
+    if timeout != None:
+        params["timeout"] = timeout
+    return params
+
+# Each line asks for up to MAX_CHOICES choices; custom_id is
+# "{chunk}-{chunk count}-{prompt index}-{prompt count}"
 def _generate_prompts_json(prompt, system_prompt, index, total_count, max_tokens=None, temperature=0, model="gpt-4o-mini", compute_count=1):
     output = []
-    for i in range(compute_count):
-        if max_tokens == None:
-            output.append({
-                "custom_id": f"{i}-{compute_count}-{index}-{total_count}",
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": model,
-                    "temperature": temperature,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                }
-            })
-        else:
-            output.append({
-                "custom_id": f"{i}-{compute_count}-{index}-{total_count}",
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": model,
-                    "temperature": temperature,
-                    "messages": [
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ],
-                    "max_tokens": max_tokens
-                }
-            })
+    messages = build_messages(prompt, system_prompt)
+    chunks = _choice_chunks(compute_count)
+    for i, n in enumerate(chunks):
+        output.append({
+            "custom_id": f"{i}-{len(chunks)}-{index}-{total_count}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _completion_params(model, messages, temperature, max_tokens, n)
+        })
 
     return output
\ No newline at end of file
@@ -7,6 +7,8 @@ import string
 from typing import List
 from .vllm import prepare_batch
 from .vllm import retrieve_batch as r_batch
+from .messages import build_prompt
+from .streaming import DEF_ANSWER_GRACE
 
 DEF_MODEL = None
 DEF_TEMPERATURE = None
@@ -26,15 +28,21 @@ def send_batch(
     temperature : float | None = 1.0,
     response_count : int | None = 1,
     gpu_count : int | None = 1,
-    gpu_type : str | None = "h200"
+    gpu_type : str | None = "h200",
+    stop_on_answer : bool | None = False,
+    answer_grace : int | None = DEF_ANSWER_GRACE
 ):
+    if system_prompts != None:
+        prompts = [build_prompt(prompt, system_prompt) for prompt, system_prompt in zip(prompts, system_prompts)]
     batch_id, command = prepare_batch(
         prompts, 
         model,
         response_count=response_count,
         gpu_count=gpu_count,
         gpu_type=gpu_type,
-        temperature=temperature
+        temperature=temperature,
+        stop_on_answer=stop_on_answer,
+        answer_grace=answer_grace
     )
 
     print("=====================================================")
@@ -43,7 +51,7 @@ def send_batch(
     print(command)
     print("\nExpect output on batch id:", batch_id)
     print("=====================================================")
-    return None
+    return batch_id
     
 def retrieve_batch(
     batch_id : str
@@ -0,0 +1,21 @@
+# Every pipe assembles its requests here, so that the part shared between
+# requests (the system prompt, then the Challenger's instructions and
+# template) always comes first and in the same form, whether a request is
+# sent on its own or in a batch. Providers and vLLM cache prompts by prefix:
+# a message order or an empty system message that differs between requests
+# would make the shared prefix miss the cache.
+
+
+def build_messages(prompt, system_prompt=None):
+    messages = []
+    if system_prompt != None and system_prompt != "":
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+# Plain-text form for backends that take raw prompts (vLLM)
+def build_prompt(prompt, system_prompt=None):
+    if system_prompt == None or system_prompt == "":
+        return prompt
+    return system_prompt + "\n\n" + prompt
@@ -8,14 +8,56 @@ class Pipeline:
         if source == None:
             return
         self.PIPE_NAME = pipe_name
+        # The pipe module is imported on first use of one of its attributes
+        self.source = source
+        self.loaded = False
+
+    def __getattr__(self, name):
+        if name.startswith("_") or self.__dict__.get("loaded", True):
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+
+    def _load(self):
         __parent__ = __name__[:__name__.rfind('.'):]
-        PIPE_ENTIRE_MODULE = importlib.import_module(source, package=__parent__)
+        PIPE_ENTIRE_MODULE = importlib.import_module(self.source, package=__parent__)
         self.retrieve_response = PIPE_ENTIRE_MODULE.retrieve_response
+        # Optional: pipes may expose a coroutine for the async scheduler
+        self.aretrieve_response = getattr(PIPE_ENTIRE_MODULE, "aretrieve_response", None)
+        # Optional: pipes may let the caller size their connection pool
+        self.configure_client = getattr(PIPE_ENTIRE_MODULE, "configure_client", None)
         self.send_batch = PIPE_ENTIRE_MODULE.send_batch
         self.retrieve_batch = PIPE_ENTIRE_MODULE.retrieve_batch
+        # Optional: pipes may resend the unanswered part of a finished batch
+        self.resubmit_batch = getattr(PIPE_ENTIRE_MODULE, "resubmit_batch", None)
+        self.failed_requests = getattr(PIPE_ENTIRE_MODULE, "failed_requests", None)
+        # Optional: pipes may stop a running batch
+        self.cancel_batch = getattr(PIPE_ENTIRE_MODULE, "cancel_batch", None)
         self.DEF_MODEL = PIPE_ENTIRE_MODULE.DEF_MODEL
         self.DEF_TEMPERATURE = PIPE_ENTIRE_MODULE.DEF_TEMPERATURE
+        self.MAX_CHOICES = getattr(PIPE_ENTIRE_MODULE, "MAX_CHOICES", None)
+        # Optional: retrieve_response(...) accepts stop_on_answer and answer_grace
+        self.SUPPORTS_STOP_ON_ANSWER = getattr(PIPE_ENTIRE_MODULE, "SUPPORTS_STOP_ON_ANSWER", False)
+        # Optional: retrieve_response(...) accepts client_options
+        self.SUPPORTS_CLIENT_OPTIONS = getattr(PIPE_ENTIRE_MODULE, "SUPPORTS_CLIENT_OPTIONS", False)
+        # Seconds the pipe's batch API may take; pipes without it are never
+        # sent batches by Challenger.route_problems
+        self.BATCH_WINDOW = getattr(PIPE_ENTIRE_MODULE, "BATCH_WINDOW", None)
+        self.loaded = True
+
+    def has_async(self):
+        return self.aretrieve_response != None
+
+    # Voters must be fanned out as separate single-response requests
+    def needs_fan_out(self):
+        return self.MAX_CHOICES == 1
+
+    def supports_stop_on_answer(self):
+        return self.SUPPORTS_STOP_ON_ANSWER
+
+    def supports_client_options(self):
+        return self.SUPPORTS_CLIENT_OPTIONS
 
     @staticmethod
     def get_pipes():
-        return _get_pipes()
\ No newline at end of file
+        return _get_pipes()
@@ -19,6 +19,46 @@ DEF_TEMPERATURE = 0
 DEF_RESPONSE_COUNT = 1
 DEF_MAX_TOKENS = None
 
+# Optional: the most responses a single retrieve_response(...) call should be
+# asked for. Set it to 1 if the provider has no native multi-sample option:
+# the scheduler then sends the voters as parallel requests of one response
+# each. Leave it out to receive the full response_count in one call.
+MAX_CHOICES = 1
+
+# Optional: set it to True if retrieve_response(...) (and aretrieve_response)
+# accept stop_on_answer and answer_grace. With stop_on_answer=True the
+# response should be streamed and ended answer_grace characters after its
+# \boxed{} answer has closed; pipelines/streaming.py reads OpenAI-style
+# streams this way.
+SUPPORTS_STOP_ON_ANSWER = False
+
+# Optional: seconds the provider's batch API may take to finish a batch.
+# Leave it out if the pipe has no batch API: Challenger.route_problems(...)
+# then sends every problem through retrieve_response(...).
+BATCH_WINDOW = 24 * 3600
+
+# Optional: set it to True if retrieve_response(...) (and aretrieve_response)
+# accept client_options, the Challenger's connection options as a dict with
+# the parameters of configure_client(...). Calls are then made on a client
+# built for those options, so Challengers with different options can share
+# the pipe. Clients other callers may be using must not be closed.
+SUPPORTS_CLIENT_OPTIONS = False
+
+
+
+#
+# Optional: implement configure_client(...) to set up the HTTP connection
+# pool used by the pipe. It is called with the Challenger's concurrency
+# before the first request (and again when it changes). It must not close
+# clients that other Challengers may have requests in flight on.
+# PARAMETERS:
+#       max_connections  (integer) the maximum number of open connections
+#       keepalive_expiry (float) seconds an idle connection is kept open
+#       http2            (boolean) whether to use HTTP/2
+def configure_client(max_connections=None, keepalive_expiry=None, http2=False):
+    # Write on your own
+    return None
+
 
 
 #
@@ -30,11 +70,28 @@ DEF_MAX_TOKENS = None
 #       temperature:    (float) the model temperature, if applicable
 #       response_count  (integer) the number of responses to generate
 #       max_tokens      (integer) the maximum number of tokens in the response
+#       timeout         (float) seconds before the request is abandoned, if applicable
+#
+# Build the messages with build_messages(...) (from .messages), so the
+# shared prefix of the requests is laid out like in every other pipe, and
+# report the usage block of each response with record_usage(...) (from
+# ..usage) to track prompt cache hits.
 #
 # OUTPUT:
 # The funtions should output an array of all generated 
 # responses, stored as strings
-def retrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS):
+def retrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None):
+    # Write on your own
+    return None
+
+
+
+#
+# Optional: implement aretrieve_response(...) as a coroutine with the same
+# parameters and output as retrieve_response(...). When present it is used by
+# the async scheduler, so many requests can share a single event loop.
+# If omitted, the async scheduler runs retrieve_response(...) in threads.
+async def aretrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None):
     # Write on your own
     return None
 
@@ -69,3 +126,21 @@ def send_batch(prompts, system_prompts=None, model=DEF_MODEL, temperature=DEF_TE
 def retrieve_batch(batch_id):
     # Write on your own
     return None
+
+
+
+#
+# Optional: implement resubmit_batch(...) and failed_requests(...) so that
+# the unanswered part of a finished batch can be sent again.
+# resubmit_batch(batch_id) sends it as a new batch and returns the id to pass
+# to retrieve_batch(...) for the whole job. failed_requests(batch_id, output)
+# returns, for the questions retrieve_batch(...) returned as FailedRequest
+# records, dicts with the keys "index", "prompt", "system_prompt", "model",
+# "temperature", "max_tokens" and "response_count".
+
+
+
+#
+# Optional: implement cancel_batch(batch_id) to stop a running batch. It is
+# called by Challenger.collect_problems(...) before the unfinished problems
+# of a routed run are sent through retrieve_response(...) instead.
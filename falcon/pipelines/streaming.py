@@ -0,0 +1,136 @@
+
+# Openings of an answer box (see falcon.answers)
+BOXES = ("\\boxed{", "\\fbox{")
+_TAIL = max(len(box) for box in BOXES) - 1
+# Characters a response may run on after its answer box has closed, so
+# that a closing "$" or a second box right after it is not cut off
+DEF_ANSWER_GRACE = 32
+# finish_reason recorded for a response ended by stop_on_answer
+FINISH_ANSWER = "answer"
+
+
+class AnswerWatcher:
+    # Follows a response as it is generated. done() becomes True once a
+    # balanced, non-empty \boxed{...} (or \fbox{...}) has closed and `grace`
+    # more characters have arrived without another box being opened.
+    def __init__(self, grace=DEF_ANSWER_GRACE):
+        self.grace = grace
+        self.parts = []
+        self.length = 0
+        # Brace depth inside the current box (0 outside of one)
+        self.depth = 0
+        # Whether the current box holds anything but spaces
+        self.filled = False
+        # End of the last closed box, None while no box has closed
+        self.closed_at = None
+        # End of the text scanned outside a box, which may hold the start
+        # of a "\boxed{" split across chunks
+        self.tail = ""
+
+    def feed(self, chunk):
+        start = self.length
+        self.parts.append(chunk)
+        self.length += len(chunk)
+        i = 0
+        while i < len(chunk):
+            if self.depth > 0:
+                if chunk[i] == "{":
+                    self.depth += 1
+                elif chunk[i] == "}":
+                    self.depth -= 1
+                    # An empty box (the prompt's "\boxed{}" echoed back) is no answer
+                    if self.depth == 0 and self.filled:
+                        self.closed_at = start + i + 1
+                if not chunk[i].isspace() and self.depth > 0:
+                    self.filled = True
+                i += 1
+                continue
+            text = self.tail + chunk[i:]
+            found, box = _find_box(text)
+            if found == -1:
+                self.tail = text[-_TAIL:]
+                break
+            i += found - len(self.tail) + len(box)
+            self.tail = ""
+            self.depth = 1
+            self.filled = False
+        return self.done()
+
+    def done(self):
+        if self.depth > 0 or self.closed_at == None or self.length - self.closed_at < self.grace:
+            return False
+        # Not while the text ends with what may be the start of another box
+        return not any(box.startswith(self.tail[k:]) for box in BOXES for k in range(len(self.tail)))
+
+    def text(self):
+        return "".join(self.parts)
+
+
+# Position and opening of the first box in text, (-1, None) without one
+def _find_box(text):
+    found = [(text.find(box), box) for box in BOXES if box in text]
+    return min(found) if found else (-1, None)
+
+
+# Reads a chat completion stream (OpenAI-style chunks with choices[].index,
+# choices[].delta.content and choices[].finish_reason) of n choices. With
+# stop_on_answer the stream is closed as soon as every choice has either
+# finished or emitted its answer (see AnswerWatcher). Returns the texts, the
+# finish reasons, the usage block (None when the stream was cut short) and
+# the model that answered.
+def read_stream(stream, n, stop_on_answer=False, grace=DEF_ANSWER_GRACE):
+    reader = _StreamReader(n, stop_on_answer, grace)
+    try:
+        for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close != None:
+            close()
+    return reader.result()
+
+
+async def aread_stream(stream, n, stop_on_answer=False, grace=DEF_ANSWER_GRACE):
+    reader = _StreamReader(n, stop_on_answer, grace)
+    try:
+        async for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+        if close != None:
+            # Imported here: inspect is slow to import and only the async path needs it
+            import inspect
+            closing = close()
+            if inspect.isawaitable(closing):
+                await closing
+    return reader.result()
+
+
+class _StreamReader:
+    def __init__(self, n, stop_on_answer, grace):
+        self.watchers = [AnswerWatcher(grace) for _ in range(n)]
+        self.reasons = [None] * n
+        self.stop_on_answer = stop_on_answer
+        self.usage = None
+        self.model = None
+
+    # Returns True once the rest of the stream is not needed
+    def feed(self, chunk):
+        if getattr(chunk, "usage", None) != None:
+            self.usage = chunk.usage
+        self.model = getattr(chunk, "model", None) or self.model
+        for choice in chunk.choices or []:
+            content = choice.delta.content if choice.delta != None else None
+            if content:
+                self.watchers[choice.index].feed(content)
+            if choice.finish_reason != None:
+                self.reasons[choice.index] = choice.finish_reason
+        if not self.stop_on_answer:
+            return False
+        return all(self.reasons[i] != None or self.watchers[i].done() for i in range(len(self.watchers)))
+
+    def result(self):
+        reasons = [reason if reason != None else FINISH_ANSWER for reason in self.reasons]
+        return [watcher.text() for watcher in self.watchers], reasons, self.usage, self.model
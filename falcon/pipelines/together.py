@@ -1,7 +1,13 @@
 #
 # External Imports
 import os
-from together import Together
+import logging
+import threading
+from ..usage import record_usage
+from .messages import build_messages
+from .streaming import read_stream, aread_stream, DEF_ANSWER_GRACE
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -9,7 +15,48 @@ from together import Together
 # API Key Setup
 # Use this section to set up your model authentication
 #API_KEY = os.getenv('TOGETHER_API_KEY')
-client = Together()
+
+
+
+#
+# Client Setup
+# One client per timeout, built on first use. The Together SDK keeps its own
+# per-thread HTTP sessions and does not expose pool limits, so
+# configure_client(...) only rebuilds the clients; connections are reused
+# as long as the worker threads are (see Challenger's persistent executor).
+# Its create() call takes no timeout, so the timeout is set on the client.
+clients = {}
+async_clients = {}
+# Async connections belong to the event loop that opened them
+async_client_loop = None
+client_lock = threading.Lock()
+
+def configure_client(max_connections=None, keepalive_expiry=None, http2=False):
+    global clients, async_clients
+    with client_lock:
+        clients = {}
+        async_clients = {}
+
+def _get_client(timeout=None):
+    # The together SDK is imported with the first client
+    from together import Together
+    with client_lock:
+        if timeout not in clients:
+            clients[timeout] = Together() if timeout == None else Together(timeout=timeout)
+        return clients[timeout]
+
+def _get_async_client(timeout=None):
+    global async_clients, async_client_loop
+    import asyncio
+    from together import AsyncTogether
+    loop = asyncio.get_running_loop()
+    with client_lock:
+        if async_client_loop is not loop:
+            async_clients = {}
+            async_client_loop = loop
+        if timeout not in async_clients:
+            async_clients[timeout] = AsyncTogether() if timeout == None else AsyncTogether(timeout=timeout)
+        return async_clients[timeout]
 
 
 
@@ -20,6 +67,16 @@ DEF_MODEL = "Qwen/Qwen2-72B-Instruct"
 DEF_TEMPERATURE = 0
 DEF_RESPONSE_COUNT = 1
 DEF_MAX_TOKENS = None
+# Name the token usage of the pipe is recorded under (see falcon.usage)
+PIPE_NAME = "Together"
+
+# Most choices a single request may ask for (the "n" parameter). Responses
+# beyond it are requested in further chunks.
+MAX_CHOICES = 128
+
+# retrieve_response(...) accepts stop_on_answer: the response is streamed and
+# ended shortly after its \boxed{} answer (see pipelines/streaming.py)
+SUPPORTS_STOP_ON_ANSWER = True
 
 
 
@@ -32,41 +89,55 @@ DEF_MAX_TOKENS = None
 #       temperature:    (float) the model temperature, if applicable
 #       response_count  (integer) the number of responses to generate
 #       max_tokens      (integer) the maximum number of tokens in the response
+#       timeout         (float) seconds before the request is abandoned, if applicable
+#       stop_on_answer  (boolean) end each response answer_grace characters after its \boxed{} answer
 #
 # OUTPUT:
 # The funtions should output an array of all generated 
 # responses, stored as strings
-def retrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS):
-    messages = []
+def retrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None, stop_on_answer=False, answer_grace=DEF_ANSWER_GRACE):
+    messages = build_messages(prompt, system_prompt)
 
-    if system_prompt != None:
-        messages.append({"role": "system", "content": system_prompt})
+    responses = []
 
-    messages.append({"role": "user", "content": prompt})
+    for n in _choice_chunks(response_count):
+        logger.debug("Requesting %d responses from %s for prompt %r", n, model, prompt)
+        if stop_on_answer:
+            stream = _get_client(timeout).chat.completions.create(**_completion_params(model, messages, temperature, max_tokens, n), stream=True)
+            texts, reasons, usage, stream_model = read_stream(stream, n, stop_on_answer=True, grace=answer_grace)
+            record_usage(PIPE_NAME, stream_model or model, usage, reasons)
+            responses += texts
+            continue
+        response = _get_client(timeout).chat.completions.create(**_completion_params(model, messages, temperature, max_tokens, n))
+        record_usage(PIPE_NAME, response.model, response.usage, [choice.finish_reason for choice in response.choices])
+
+        for choice in response.choices:
+            responses.append(choice.message.content)
+            logger.debug("Response from %s: %r", model, choice.message.content)
+
+    return responses
+
+
+
+#
+# Optional: implement aretrieve_response(...) as a coroutine with the same
+# parameters and output as retrieve_response(...). When present it is used by
+# the async scheduler, so many requests can share a single event loop.
+async def aretrieve_response(prompt, system_prompt=None, model=DEF_MODEL, temperature=DEF_TEMPERATURE, response_count=DEF_RESPONSE_COUNT, max_tokens=DEF_MAX_TOKENS, timeout=None, stop_on_answer=False, answer_grace=DEF_ANSWER_GRACE):
+    messages = build_messages(prompt, system_prompt)
 
     responses = []
 
-    for i in range(response_count):
-        response = None
-        print('ok')
-        print(prompt)
-        if max_tokens == None:
-            response = client.chat.completions.create(
-                model=model, 
-                messages=messages,
-                temperature=temperature
-            )
-        else:
-            response = client.chat.completions.create(
-                model=model, 
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
-
-        responses.append(response.choices[0].message.content)
-        print(response.choices[0].message.content)
-        print('\n\n\n')
+    for n in _choice_chunks(response_count):
+        if stop_on_answer:
+            stream = await _get_async_client(timeout).chat.completions.create(**_completion_params(model, messages, temperature, max_tokens, n), stream=True)
+            texts, reasons, usage, stream_model = await aread_stream(stream, n, stop_on_answer=True, grace=answer_grace)
+            record_usage(PIPE_NAME, stream_model or model, usage, reasons)
+            responses += texts
+            continue
+        response = await _get_async_client(timeout).chat.completions.create(**_completion_params(model, messages, temperature, max_tokens, n))
+        record_usage(PIPE_NAME, response.model, response.usage, [choice.finish_reason for choice in response.choices])
+        responses += [choice.message.content for choice in response.choices]
 
     return responses
 
@@ -101,3 +172,24 @@ def send_batch(prompts, system_prompts=None, model=DEF_MODEL, temperature=DEF_TE
 def retrieve_batch(batch_id):
     # Write on your own
     return None
+
+
+
+def _choice_chunks(response_count):
+    chunks = []
+    while response_count > 0:
+        chunks.append(min(response_count, MAX_CHOICES))
+        response_count -= chunks[-1]
+    return chunks
+
+def _completion_params(model, messages, temperature, max_tokens, n):
+    params = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature
+    }
+    if max_tokens != None:
+        params["max_tokens"] = max_tokens
+    if n > 1:
+        params["n"] = n
+    return params
@@ -33,6 +33,8 @@ def shell_gen_command(
     temperature : float | None = None,
     max_tokens : int | None = 16000,
     gpu_count : int | None = 1,
+    stop_on_answer : bool | None = False,
+    answer_grace : int | None = 32,
     python_name : str | None = "python"
 ):
     command = ' '.join([python_name, "./runner.py", input_name, output_name])
@@ -45,6 +47,8 @@ def shell_gen_command(
         command += (" --temperature " + str(temperature))
     if max_tokens != None:
         command += (" --max_tokens " + str(max_tokens))
+    if stop_on_answer:
+        command += (" --stop_on_answer --answer_grace " + str(answer_grace))
     return command
 
 def shell_gen_file(
@@ -88,7 +92,9 @@ def prepare_batch(
     gpu_count : int | None = 1,
     gpu_type : str | None = "a6000",
     temperature : float | None = 1.0,
-    max_tokens : int | None = 16000
+    max_tokens : int | None = 16000,
+    stop_on_answer : bool | None = False,
+    answer_grace : int | None = 32
 ):
     current_directory = os.path.dirname(os.path.realpath(__file__))
     input_directory = os.path.join(current_directory, "input")
@@ -109,7 +115,9 @@ def prepare_batch(
         model=model,
         temperature=temperature,
         max_tokens=max_tokens,
-        gpu_count=gpu_count
+        gpu_count=gpu_count,
+        stop_on_answer=stop_on_answer,
+        answer_grace=answer_grace
     )
 
     shell = shell_gen_file(
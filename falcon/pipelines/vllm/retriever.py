@@ -1,5 +1,6 @@
 import os
 import json
+from ...usage import record_usage, claim_batch_usage
 
 def split_array(arr, n):
     avg = len(arr) // n
@@ -20,10 +21,17 @@ def retrieve_batch(
 ):
     current_directory = os.path.dirname(os.path.realpath(__file__))
     json_path = os.path.join(current_directory, "output", batch_id + ".json")
+    # The job has not finished (its output is copied back at the very end)
+    if not os.path.exists(json_path):
+        return None
     with open(json_path, 'r', encoding='utf-8') as file:
         data = json.load(file)
         res_count = data['response_count']
         results = data['results']
         if len(results) % res_count != 0:
             raise Exception("Invalid file.")
+        # Totals of the whole batch, recorded as one request the first time
+        # the batch is retrieved
+        if claim_batch_usage("vLLM", batch_id):
+            record_usage("vLLM", data.get('model'), data.get('usage'))
         return split_array(results, int(len(results) / res_count))
\ No newline at end of file
@@ -16,35 +16,121 @@ def load_input(
         return prompts
 
 
+class AnswerStop:
+    # Logits processor ending a generation once a balanced, non-empty
+    # \boxed{...} (or \fbox{...}) has closed and `grace` more characters were
+    # generated. It mirrors falcon.pipelines.streaming.AnswerWatcher, since
+    # this script runs on its own on the cluster. One instance (and so one
+    # SamplingParams) per prompt. Per-request logits processors only run on
+    # vLLM's V0 engine (see run_vllm and environment.yml).
+    BOXES = ("\\boxed{", "\\fbox{")
+
+    def __init__(self, tokenizer, grace):
+        self.tokenizer = tokenizer
+        self.grace = grace
+        self.seen = 0
+        self.length = 0
+        self.depth = 0
+        self.filled = False
+        self.closed_at = None
+        self.tail = ""
+
+    def __call__(self, token_ids, logits):
+        if len(token_ids) > self.seen:
+            self.feed(self.tokenizer.decode(token_ids[self.seen:]))
+            self.seen = len(token_ids)
+        if self.depth == 0 and self.closed_at != None and self.length - self.closed_at >= self.grace:
+            logits.fill_(float("-inf"))
+            logits[self.tokenizer.eos_token_id] = 0.0
+        return logits
+
+    def feed(self, chunk):
+        start = self.length
+        self.length += len(chunk)
+        i = 0
+        while i < len(chunk):
+            if self.depth > 0:
+                if chunk[i] == "{":
+                    self.depth += 1
+                elif chunk[i] == "}":
+                    self.depth -= 1
+                    # An empty box (the prompt's "\boxed{}" echoed back) is no answer
+                    if self.depth == 0 and self.filled:
+                        self.closed_at = start + i + 1
+                if not chunk[i].isspace() and self.depth > 0:
+                    self.filled = True
+                i += 1
+                continue
+            text = self.tail + chunk[i:]
+            found = [(text.find(box), box) for box in self.BOXES if box in text]
+            if not found:
+                self.tail = text[-(max(len(box) for box in self.BOXES) - 1):]
+                break
+            found, box = min(found)
+            i += found - len(self.tail) + len(box)
+            self.tail = ""
+            self.depth = 1
+            self.filled = False
+
+
 def run_vllm(
     model : str,
     prompts : List[str],
     *,
     temperature : float | None = 1.0,
     max_tokens : int | None = None,
-    gpu_count : int | None = 1
+    gpu_count : int | None = 1,
+    stop_on_answer : bool | None = False,
+    answer_grace : int | None = 32
 ) -> List[str]:
+    if stop_on_answer:
+        # The V1 engine rejects per-request logits processors (AnswerStop);
+        # the vLLM pinned in environment.yml still ships V0
+        os.environ["VLLM_USE_V1"] = "0"
     # Load LLM
-    llm = LLM(model=model, gpu_memory_utilization=0.9, tensor_parallel_size=gpu_count)
+    # Prompts share the Challenger's instructions (and voters the whole
+    # prompt), so their KV cache blocks are reused across requests
+    llm = LLM(model=model, gpu_memory_utilization=0.9, tensor_parallel_size=gpu_count, enable_prefix_caching=True)
     # Set up sampling parameters
     sampling_params = (SamplingParams(temperature=temperature, max_tokens=max_tokens) if max_tokens != None 
                         else SamplingParams(temperature=temperature))
+    if stop_on_answer:
+        # Logits processors keep per-generation state: one SamplingParams per prompt
+        tokenizer = llm.get_tokenizer()
+        sampling_params = [sampling_params.clone() for _ in prompts]
+        for params in sampling_params:
+            params.logits_processors = [AnswerStop(tokenizer, answer_grace)]
     # Run LLM
     outputs = llm.generate(prompts, sampling_params)
     # Return output
     return outputs
 
 
+def count_usage(
+    generated
+) -> dict:
+    # num_cached_tokens is only reported by recent vLLM versions
+    return {
+        'prompt_tokens': sum(len(output.prompt_token_ids) for output in generated),
+        'cached_tokens': sum(getattr(output, 'num_cached_tokens', None) or 0 for output in generated),
+        'completion_tokens': sum(len(output.outputs[0].token_ids) for output in generated)
+    }
+
+
 def save_output(
     outputs : List[str],
     rel_path : str,
-    response_count : int | None = 1
+    response_count : int | None = 1,
+    model : str | None = None,
+    usage : dict | None = None
 ) -> None:
     current_directory = os.path.dirname(os.path.realpath(__file__))
     file_path = os.path.join(current_directory, "output", rel_path)
     data_dict = {
         'response_count': response_count,
-        'results': outputs
+        'results': outputs,
+        'model': model,
+        'usage': usage
     }
     with open(file_path, 'w') as file:
         json.dump(data_dict, file)
@@ -66,19 +152,29 @@ def main():
     parser.add_argument("--temperature", type=float, help="Model temperature", default=1.0)
     parser.add_argument("--max_tokens", type=int, help="Maximum number of generated tokens", default=None)
     parser.add_argument("--gpu_count", type=int, help="Number is GPUs to except", default=1)
+    parser.add_argument("--stop_on_answer", action="store_true", help="End generations shortly after their \\boxed{} answer")
+    parser.add_argument("--answer_grace", type=int, help="Characters generated after the answer box closes", default=32)
     args = parser.parse_args()
 
     # Load prompts
     prompts = load_input(args.input, args.response_count)
 
     # Run model
-    generated = run_vllm(args.model, prompts, temperature=args.temperature, max_tokens=args.max_tokens, gpu_count=args.gpu_count)
+    generated = run_vllm(
+        args.model,
+        prompts,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        gpu_count=args.gpu_count,
+        stop_on_answer=args.stop_on_answer,
+        answer_grace=args.answer_grace
+    )
     
     # Extract Outputs
     outputs = [output.outputs[0].text.strip() for output in generated]
     
     # Save Outputs
-    save_output(outputs, args.output, args.response_count)
+    save_output(outputs, args.output, args.response_count, model=args.model, usage=count_usage(generated))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,179 @@
+import math
+import time
+import threading
+
+# Rough characters-per-token ratio used to estimate prompt size
+CHARS_PER_TOKEN = 4
+# Completion size assumed when max_tokens is not set
+DEF_COMPLETION_TOKENS = 1024
+# How often a waiting request re-checks for a free concurrency slot
+POLL_INTERVAL = 0.05
+
+_BUDGETS = {}
+_BUDGETS_LOCK = threading.Lock()
+# Default of the configure methods: the setting is left as it is
+_UNSET = object()
+
+
+def estimate_tokens(prompt, max_tokens=None, response_count=1):
+    prompt_tokens = math.ceil(len(prompt) / CHARS_PER_TOKEN)
+    completion_tokens = DEF_COMPLETION_TOKENS if max_tokens == None else max_tokens
+    return (prompt_tokens + completion_tokens) * (response_count or 1)
+
+
+# Requests and tokens of one scheduled call. The pipes issue one API call per
+# chunk of at most max_choices responses (the pipe's MAX_CHOICES; None: all
+# responses in one call), while every response counts for the tokens.
+def request_cost(prompt, max_choices=None, **kwargs):
+    response_count = kwargs.get("response_count") or 1
+    requests = 1 if max_choices == None else math.ceil(response_count / max_choices)
+    tokens = estimate_tokens(prompt, kwargs.get("max_tokens"), response_count)
+    return requests, tokens
+
+
+def is_rate_limit_error(e):
+    return "rate limit" in str(e).lower() or "429" in str(e)
+
+
+class TokenBucket:
+    # Refills continuously at per_minute / 60 units per second. Reservations
+    # may drive the level negative; the caller then waits until it is repaid,
+    # which keeps callers in arrival order without a queue.
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        # A single request larger than the bucket could otherwise never run
+        self.level -= min(amount, self.capacity)
+        return 0 if self.level >= 0 else -self.level / self.rate
+
+
+class RateBudget:
+    # Requests-per-minute / tokens-per-minute budgets of one provider model,
+    # shared by every Challenger using it (see get_rate_budget)
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        self.requests_per_minute = None
+        self.tokens_per_minute = None
+        self.requests = None
+        self.tokens = None
+        self.configure(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+    # Only the budgets passed are changed, and only rebuilt when they change:
+    # a caller leaving one out keeps the one another caller chose
+    def configure(self, requests_per_minute=_UNSET, tokens_per_minute=_UNSET):
+        with self.lock:
+            if requests_per_minute is not _UNSET and requests_per_minute != self.requests_per_minute:
+                self.requests_per_minute = requests_per_minute
+                self.requests = None if requests_per_minute == None else TokenBucket(requests_per_minute)
+            if tokens_per_minute is not _UNSET and tokens_per_minute != self.tokens_per_minute:
+                self.tokens_per_minute = tokens_per_minute
+                self.tokens = None if tokens_per_minute == None else TokenBucket(tokens_per_minute)
+
+    def limited(self):
+        return self.requests != None or self.tokens != None
+
+    # Seconds to wait before the request fits in the budgets
+    def reserve(self, requests, tokens):
+        with self.lock:
+            wait = 0
+            if self.requests != None:
+                wait = max(wait, self.requests.reserve(requests))
+            if self.tokens != None:
+                wait = max(wait, self.tokens.reserve(tokens))
+            return wait
+
+
+class RateLimiter:
+    # The concurrency limit of one Challenger in front of the shared budgets
+    # of its provider model (a RateBudget, or None): with adaptive=True the
+    # limit grows additively while calls succeed and is cut multiplicatively
+    # on every rate-limit error. Each Challenger has its own, so one running
+    # at a low concurrency does not slow down the others.
+    def __init__(self, budget=None, max_concurrency=8, min_concurrency=1, adaptive=True, decrease=0.5):
+        self.lock = threading.Lock()
+        self.budget = budget
+        self.in_flight = 0
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.adaptive = adaptive
+        self.decrease = decrease
+        self.limit = float(max_concurrency)
+        self.configure(max_concurrency=max_concurrency, min_concurrency=min_concurrency, adaptive=adaptive, decrease=decrease)
+
+    # Only the settings passed are changed. The learned concurrency limit
+    # survives reconfiguration (clamped to the new bounds), except that a
+    # raised max_concurrency starts from the new maximum: growing back one
+    # slot per limit's worth of successes would take far too long.
+    def configure(self, max_concurrency=_UNSET, min_concurrency=_UNSET, adaptive=_UNSET, decrease=_UNSET):
+        with self.lock:
+            if max_concurrency is not _UNSET:
+                if max_concurrency > self.max_concurrency:
+                    self.limit = float(max_concurrency)
+                self.max_concurrency = max_concurrency
+            if min_concurrency is not _UNSET:
+                self.min_concurrency = min_concurrency
+            self.min_concurrency = min(self.min_concurrency, self.max_concurrency)
+            if adaptive is not _UNSET:
+                self.adaptive = adaptive
+            if decrease is not _UNSET:
+                self.decrease = decrease
+            self.limit = float(self.max_concurrency) if not self.adaptive else min(max(self.limit, self.min_concurrency), self.max_concurrency)
+
+    def concurrency(self):
+        return int(self.limit)
+
+    def try_enter(self):
+        with self.lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def reserve(self, requests, tokens):
+        return 0 if self.budget == None else self.budget.reserve(requests, tokens)
+
+    def acquire(self, requests=1, tokens=0):
+        while not self.try_enter():
+            time.sleep(POLL_INTERVAL)
+        wait = self.reserve(requests, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, requests=1, tokens=0):
+        import asyncio
+        while not self.try_enter():
+            await asyncio.sleep(POLL_INTERVAL)
+        wait = self.reserve(requests, tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, rate_limited=False):
+        with self.lock:
+            self.in_flight -= 1
+            if not self.adaptive:
+                return
+            if rate_limited:
+                self.limit = max(self.min_concurrency, self.limit * self.decrease)
+            else:
+                # Grows by roughly one slot per limit's worth of successes
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+
+def get_rate_budget(pipename, model, **kwargs):
+    # Budgets are shared per (pipe, model) so that every Challenger hitting
+    # the same provider model draws from them; kwargs holds only the budgets
+    # the caller chose (see RateBudget.configure)
+    with _BUDGETS_LOCK:
+        key = (pipename, model)
+        if key not in _BUDGETS:
+            _BUDGETS[key] = RateBudget(**kwargs)
+        else:
+            _BUDGETS[key].configure(**kwargs)
+        return _BUDGETS[key]
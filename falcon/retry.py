@@ -0,0 +1,218 @@
+import re
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from .ratelimit import is_rate_limit_error
+
+# Error classes
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# Reasons recorded on a FailedRequest
+REASON_FATAL = "fatal"
+REASON_EXHAUSTED = "retries_exhausted"
+REASON_CIRCUIT_OPEN = "circuit_open"
+REASON_CANCELLED = "cancelled"
+REASON_DEADLINE = "deadline_exceeded"
+
+# Exception class names raised by the openai and together SDKs. Matching on
+# names (across the MRO) keeps both SDKs optional imports. Programming and
+# setup errors (a missing module, a bad argument) are fatal too: retrying
+# them only hides the bug.
+_RATE_LIMIT_ERRORS = {"RateLimitError"}
+_FATAL_ERRORS = {
+    "AuthenticationError",
+    "PermissionDeniedError",
+    "BadRequestError",
+    "NotFoundError",
+    "UnprocessableEntityError",
+    "InvalidRequestError",
+    "NotImplementedError",
+    "ImportError",
+    "TypeError",
+    "ValueError"
+}
+_TRANSIENT_ERRORS = {
+    "APITimeoutError",
+    "APIConnectionError",
+    "InternalServerError",
+    "ServiceUnavailableError",
+    "Timeout",
+    "TimeoutError",
+    "ConnectionError"
+}
+
+_RETRY_HEADERS = ["retry-after-ms", "retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens", "x-ratelimit-reset"]
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+class FailedRequest:
+    # Returned by the schedulers in place of a response list when a prompt
+    # could not be answered. It is falsy so `if response:` skips it.
+    def __init__(self, reason, error=None, attempts=0):
+        self.reason = reason
+        self.error_type = None if error == None else type(error).__name__
+        self.error = None if error == None else str(error)
+        self.attempts = attempts
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f"FailedRequest(reason={self.reason!r}, error_type={self.error_type!r}, attempts={self.attempts})"
+
+
+def _status_code(e):
+    status = getattr(e, "status_code", None)
+    if status == None:
+        status = getattr(e, "http_status", None)
+    return status if isinstance(status, int) else None
+
+
+def classify(e):
+    names = {cls.__name__ for cls in type(e).__mro__}
+    status = _status_code(e)
+    if names & _RATE_LIMIT_ERRORS or status == 429:
+        return RATE_LIMIT
+    if names & _FATAL_ERRORS:
+        return FATAL
+    if names & _TRANSIENT_ERRORS:
+        return TRANSIENT
+    if status != None:
+        if status >= 500 or status in (408, 409):
+            return TRANSIENT
+        if status >= 400:
+            return FATAL
+    if is_rate_limit_error(e):
+        return RATE_LIMIT
+    return TRANSIENT
+
+
+def _parse_duration(value):
+    # Accepts plain seconds ("2", "0.5") and Go-style durations ("6m0s", "150ms")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if len(parts) == 0:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(e):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers == None:
+        headers = getattr(e, "headers", None)
+    if not headers:
+        return None
+    for key in _RETRY_HEADERS:
+        value = headers.get(key)
+        if value == None:
+            continue
+        value = str(value).strip()
+        if key == "retry-after-ms":
+            seconds = _parse_duration(value)
+            seconds = None if seconds == None else seconds / 1000
+        else:
+            seconds = _parse_duration(value)
+        if seconds == None and key == "retry-after":
+            # HTTP-date form
+            from email.utils import parsedate_to_datetime
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                seconds = None
+        elif seconds != None and seconds > 1e9:
+            # Epoch timestamp rather than a delta
+            seconds = seconds - time.time()
+        if seconds != None:
+            return max(0, seconds)
+    return None
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter. Rate-limit errors are retried on
+    # their own (larger) budget; a Retry-After style header, when present,
+    # overrides the computed delay if it is longer.
+    def __init__(self, max_retries=8, base_delay=0.5, max_delay=60, max_rate_limit_retries=32):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_rate_limit_retries = max_rate_limit_retries
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def delay(self, attempt, error=None):
+        wait = self.backoff(attempt)
+        if error != None:
+            hint = retry_after(error)
+            if hint != None:
+                wait = max(wait, min(hint, self.max_delay))
+        return wait
+
+    def should_retry(self, kind, failures, rate_limits):
+        if kind == FATAL:
+            return False
+        if kind == RATE_LIMIT:
+            return rate_limits < self.max_rate_limit_retries
+        return failures < self.max_retries
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive transient failures and stops
+    # requests for reset_timeout seconds. Then a single probe is let through:
+    # success closes the breaker, failure opens it again.
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def is_open(self):
+        return self.opened_at != None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at == None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                return True
+            return False
+
+    def remaining(self):
+        with self.lock:
+            if self.opened_at == None:
+                return 0
+            return max(0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+def get_circuit_breaker(pipename, **kwargs):
+    with _BREAKERS_LOCK:
+        if pipename not in _BREAKERS:
+            _BREAKERS[pipename] = CircuitBreaker(**kwargs)
+        return _BREAKERS[pipename]
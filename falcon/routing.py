@@ -0,0 +1,81 @@
+import time
+
+# Fewest requests (problems × voters) worth sending through a batch API;
+# smaller workloads finish sooner through the sync scheduler
+MIN_BATCH_REQUESTS = 1000
+# Shortest deadline (seconds) for which a batch is sent at all
+MIN_BATCH_DEADLINE = 3600
+# Share of the deadline the batch is given before its unfinished problems
+# are moved to the sync scheduler
+BATCH_SHARE = 0.75
+# Seconds between polls of a routed batch while waiting for it
+POLL_INTERVAL = 30
+# Seconds a batch cancelled at the cutoff is waited for to wind down, so
+# that the requests it already answered are kept; never more than half the
+# time the run has left, which the sync scheduler needs
+CANCEL_WAIT = 120
+
+
+# Splits `count` problems between the sync scheduler and the pipe's batch
+# API. Urgent problems always go through the sync scheduler; the rest are
+# batched when the pipe has a batch API, the workload is large enough and
+# the deadline leaves the batch time to run. Returns the sync and the batch
+# indices.
+def plan_route(count, voters, batch_window, deadline=None, urgent=None, min_batch_requests=MIN_BATCH_REQUESTS):
+    urgent = set() if urgent == None else set(urgent)
+    rest = [i for i in range(count) if i not in urgent]
+    sync = [i for i in range(count) if i in urgent]
+    if batch_window == None or len(rest) * voters < min_batch_requests:
+        return sync + rest, []
+    if deadline != None and deadline * BATCH_SHARE < MIN_BATCH_DEADLINE:
+        return sync + rest, []
+    return sync, rest
+
+
+class RoutedRun:
+    # A run split by Challenger.route_problems. The sync part is answered
+    # when the run is created; the batch part is collected (or moved to the
+    # sync scheduler once `cutoff` has passed) by Challenger.collect_problems.
+    def __init__(self, prompts, voters, sync_indices, batch_indices, batch_id=None, cutoff=None, cancel=None):
+        self.prompts = prompts
+        self.voters = voters
+        self.sync_indices = sync_indices
+        self.batch_indices = batch_indices
+        self.batch_id = batch_id
+        # Monotonic time after which the batch is no longer waited for
+        self.cutoff = cutoff
+        # Set when the batch is cancelled: monotonic time until which its
+        # partial results are waited for
+        self.cancel_cutoff = None
+        self.cancel = cancel
+        # Raw responses (or FailedRequest records) by problem index
+        self.output = {}
+        # Batch problems that were answered through the sync scheduler
+        self.rerouted = 0
+
+    def done(self):
+        return len(self.output) == len(self.prompts)
+
+    def past_cutoff(self):
+        return self.cutoff != None and time.monotonic() >= self.cutoff
+
+    # Called once the batch is cancelled at the cutoff
+    def wait_for_cancel(self):
+        wait = CANCEL_WAIT
+        remaining = None if self.cancel == None else self.cancel.remaining()
+        if remaining != None:
+            wait = min(wait, remaining / 2)
+        self.cancel_cutoff = time.monotonic() + wait
+
+    def past_cancel_cutoff(self):
+        return self.cancel_cutoff != None and time.monotonic() >= self.cancel_cutoff
+
+    def stats(self):
+        return {
+            "problems": len(self.prompts),
+            "sync": len(self.sync_indices),
+            "batch": len(self.batch_indices),
+            "batch_id": self.batch_id,
+            "rerouted": self.rerouted,
+            "answered": len(self.output)
+        }
@@ -1,40 +1,488 @@
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed, ProcessPoolExecutor
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .ratelimit import request_cost
+from .budget import DEF_PRIORITY, new_run_id
+from .retry import RetryPolicy, FailedRequest, classify, RATE_LIMIT, FATAL, REASON_FATAL, REASON_EXHAUSTED, REASON_CIRCUIT_OPEN, REASON_CANCELLED, REASON_DEADLINE
+from .cancel import CancelToken
+
+class _RetryState:
+    def __init__(self):
+        self.attempts = 0
+        self.failures = 0
+        self.rate_limits = 0
+        self.error = None
+
+def _merge_fan_out(results):
+    # results: (task index, result) pairs, merged back in voter order
+    results = [res for _, res in sorted(results, key=lambda entry: entry[0])]
+    responses = []
+    for res in results:
+        if not isinstance(res, FailedRequest):
+            responses += res
+    if len(responses) == 0:
+        return results[0]
+    return responses
+
+def _stop_reason(cancel):
+    if cancel == None or not cancel.stopped():
+        return None
+    return REASON_CANCELLED if cancel.cancelled() else REASON_DEADLINE
+
+def _copy_result(res):
+    return list(res) if isinstance(res, list) else res
+
+class _InFlight:
+    # Maps in-flight futures/tasks to the task indices waiting on them, so that
+    # identical (prompt, voters) tasks share a single call
+    def __init__(self, coalesce):
+        self.coalesce = coalesce
+        self.handle_by_key = {}
+        self.key_by_handle = {}
+        self.indices = {}
+        self.waiting = 0
+
+    def attach(self, i, prompt, voters):
+        handle = self.handle_by_key.get((prompt, tuple(voters))) if self.coalesce else None
+        if handle == None:
+            return False
+        self.indices[handle].append(i)
+        self.waiting += 1
+        return True
+
+    def add(self, handle, i, prompt, voters):
+        key = (prompt, tuple(voters))
+        if self.coalesce:
+            self.handle_by_key[key] = handle
+        self.key_by_handle[handle] = key
+        self.indices[handle] = [i]
+        self.waiting += 1
+
+    def complete(self, handle):
+        key = self.key_by_handle.pop(handle)
+        if self.handle_by_key.get(key) is handle:
+            del self.handle_by_key[key]
+        indices = self.indices.pop(handle)
+        self.waiting -= len(indices)
+        return indices
+
+    def handles(self):
+        return list(self.indices)
 
 class Scheduler:
-    def __init__(self, function, concurrent_requests=8, max_retries=8, delay=0.1):
+    def __init__(self, function, concurrent_requests=8, max_retries=8, delay=0.1, rate_limiter=None, retry_policy=None, circuit_breaker=None, fan_out=False, max_choices=None, cache=None, cache_namespace=None, coalesce=True, collapse_voters=False, journal=None, executor=None, budget=None, priority=DEF_PRIORITY, hedge=None, fallback=None, fallback_kwargs=None, cancel=None, metrics=None):
         self.function = function
         self.concurrent_requests = concurrent_requests
         self.max_retries = max_retries
         self.delay = delay
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy if retry_policy != None else RetryPolicy(max_retries=max_retries)
+        self.circuit_breaker = circuit_breaker
+        # Split response_count into parallel single-response requests
+        self.fan_out = fan_out
+        # The pipe's MAX_CHOICES: responses per API call, for the rate limiter
+        self.max_choices = max_choices
+        # Optional ResponseCache; the namespace (the pipe name) is part of every key
+        self.cache = cache
+        self.cache_namespace = cache_namespace
+        # Identical in-flight (prompt, voters) tasks share one call
+        self.coalesce = coalesce
+        # At temperature 0, request a single response and replicate it to every voter
+        self.collapse_voters = collapse_voters
+        # Optional Journal checkpointing every response of this run
+        self.journal = journal
+        # Long-lived executor owned by the caller; a fresh one per run otherwise
+        self.executor = executor
+        # Optional process-wide ProviderBudget; each Scheduler is one run in it
+        self.budget = budget
+        self.priority = priority
+        self.run_id = new_run_id()
+        # Optional HedgePolicy; slow calls are duplicated to `fallback` (a
+        # Scheduler for another pipe, or this one) with fallback_kwargs applied
+        self.hedge = hedge
+        self.fallback = fallback
+        self.fallback_kwargs = fallback_kwargs if fallback_kwargs != None else {}
+        self.hedge_pool = None
+        # Optional CancelToken (and deadline) for the whole run
+        self.cancel = cancel
+        # Optional PipeMetrics recording every call made to the pipe
+        self.metrics = metrics
     
     def run(self, prompts, **kwargs):
-        total = len(prompts)
-        completed = 0
-        output = [[]] * total
-
-        with ThreadPoolExecutor(max_workers=self.concurrent_requests) as executor:
-            future_to_index = {
-                executor.submit(self.run_with_retries, prompt, **kwargs): i
-                for i, prompt in enumerate(prompts)
-            }
-            for future in as_completed(future_to_index):
-                idx = future_to_index[future]
-                output[idx] = future.result()
-                completed += 1
-                if completed == total:
+        output = [None] * len(prompts)
+        distinct, positions = self._distinct(prompts)
+        for idx, result in self.run_iter(distinct, **kwargs):
+            for i in positions[idx]:
+                output[i] = _copy_result(result)
+        return self.mark_unfinished(output)
+
+    # Prompts never started because the run was cancelled or ran out of time
+    def mark_unfinished(self, output):
+        reason = self.stop_reason()
+        if reason != None:
+            output = [FailedRequest(reason) if res == None else res for res in output]
+        return output
+
+    def stop_reason(self):
+        return _stop_reason(self.cancel)
+
+    def _distinct(self, prompts):
+        # Duplicates in the whole list are sent once and fanned back out
+        if not self.coalesce:
+            return prompts, [[i] for i in range(len(prompts))]
+        index_of = {}
+        distinct = []
+        positions = []
+        for i, prompt in enumerate(prompts):
+            if prompt not in index_of:
+                index_of[prompt] = len(distinct)
+                distinct.append(prompt)
+                positions.append([])
+            positions[index_of[prompt]].append(i)
+        return distinct, positions
+
+    def _collapses(self, count, kwargs):
+        return self.collapse_voters and count > 1 and kwargs.get("temperature") == 0
+
+    # Yields (index, result) in completion order. Prompts are pulled lazily
+    # from any iterable and at most `window` of them are submitted at a time
+    # (twice concurrent_requests by default), so memory stays flat.
+    # Responses are numbered as voters first_voter, first_voter + 1, ...
+    def run_iter(self, prompts, window=None, first_voter=0, **kwargs):
+        count = kwargs.get("response_count") or 1
+        if self._collapses(count, kwargs):
+            kwargs["response_count"] = 1
+            for idx, res in self.run_iter(prompts, window, first_voter=first_voter, **kwargs):
+                yield idx, res if isinstance(res, FailedRequest) else res * count
+            return
+        if not self.fan_out or count == 1:
+            tasks = ((prompt, list(range(first_voter, first_voter + count))) for prompt in prompts)
+            yield from self._run_iter(tasks, window, **kwargs)
+            return
+        tasks = ((prompt, [first_voter + voter]) for prompt in prompts for voter in range(count))
+        partial = {}
+        for j, res in self._run_iter(tasks, window, **kwargs):
+            idx = j // count
+            partial.setdefault(idx, []).append((j, res))
+            if len(partial[idx]) == count:
+                yield idx, _merge_fan_out(partial.pop(idx))
+        # A stopped run leaves prompts with only some of their voters
+        for idx in list(partial):
+            yield idx, _merge_fan_out(partial.pop(idx))
+
+    # Yields (index, responses) for every wave of every prompt as it returns.
+    # Each prompt is asked for `wave` responses at a time (voters 0, 1, ...
+    # in turn) up to response_count, and its next wave is submitted as soon
+    # as its own previous wave is back, whatever the other prompts are
+    # doing. done(responses, remaining), given the prompt's responses so far
+    # and the number of voters not requested yet, ends the prompt when it
+    # returns True; so does a failed wave (a FailedRequest).
+    def run_waves(self, prompts, wave, done, window=None, **kwargs):
+        voters = kwargs.get("response_count") or 1
+        if self._collapses(voters, kwargs):
+            # Every voter gets the same response: one request settles the prompt
+            yield from self.run_iter(prompts, window, **kwargs)
+            return
+        prompts = list(prompts)
+        requested = [0] * len(prompts)
+        responses = [[] for _ in prompts]
+        numbers = itertools.count()
+        # Task number -> prompt index, and per prompt the results of its
+        # current wave with the number of tasks it was split into
+        owner = {}
+        waves = {}
+        follow_ups = deque()
+
+        def next_wave(idx):
+            first = requested[idx]
+            count = min(wave, voters - first)
+            requested[idx] += count
+            if self.fan_out:
+                voter_lists = [[voter] for voter in range(first, first + count)]
+            else:
+                voter_lists = [list(range(first, first + count))]
+            waves[idx] = (len(voter_lists), [])
+            for voter_list in voter_lists:
+                number = next(numbers)
+                owner[number] = idx
+                follow_ups.append((number, (prompts[idx], voter_list)))
+
+        for idx in range(len(prompts)):
+            next_wave(idx)
+        for number, res in self._run_iter((), window, follow_ups, **kwargs):
+            idx = owner.pop(number)
+            size, results = waves[idx]
+            results.append((number, res))
+            if len(results) < size:
+                continue
+            del waves[idx]
+            res = _merge_fan_out(results)
+            yield idx, res
+            if isinstance(res, FailedRequest):
+                continue
+            responses[idx] += res
+            remaining = voters - requested[idx]
+            if remaining > 0 and not done(responses[idx], remaining):
+                next_wave(idx)
+        # A stopped run leaves waves with only some of their fan-out tasks
+        for idx in list(waves):
+            _, results = waves.pop(idx)
+            if len(results) > 0:
+                yield idx, _merge_fan_out(results)
+
+    # Yields the (index, result) of every task in `tasks`, numbered in order,
+    # and of every numbered task the consumer appends to `follow_ups` (a
+    # deque, submitted before the rest of `tasks`) while the run goes on.
+    def _run_iter(self, tasks, window, follow_ups=None, **kwargs):
+        window = window if window != None else 2 * self.concurrent_requests
+        tasks = enumerate(tasks)
+        exhausted = False
+        follow_ups = follow_ups if follow_ups != None else deque()
+
+        executor = self.executor if self.executor != None else ThreadPoolExecutor(max_workers=self.concurrent_requests)
+        if self.hedge != None:
+            # Hedged calls run here while the task's worker waits on them
+            self.hedge_pool = ThreadPoolExecutor(max_workers=2 * self.concurrent_requests)
+        in_flight = _InFlight(self.coalesce)
+        try:
+            while True:
+                # Nothing new is submitted once the run is stopped
+                while in_flight.waiting < window and self.stop_reason() == None:
+                    if len(follow_ups) > 0:
+                        entry = follow_ups.popleft()
+                    elif not exhausted:
+                        entry = next(tasks, None)
+                    else:
+                        break
+                    if entry == None:
+                        exhausted = True
+                        break
+                    i, (prompt, voters) = entry
+                    if not in_flight.attach(i, prompt, voters):
+                        in_flight.add(executor.submit(self.run_task, prompt, voters, **kwargs), i, prompt, voters)
+                if in_flight.waiting == 0:
+                    return
+                done, _ = wait(in_flight.handles(), timeout=self._remaining(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    for i in in_flight.complete(future):
+                        yield i, _copy_result(result)
+                if self._expired():
+                    # Out of time: requests still running are abandoned
+                    for future in in_flight.handles():
+                        future.cancel()
+                        for i in in_flight.complete(future):
+                            yield i, FailedRequest(REASON_DEADLINE)
+                    return
+        finally:
+            # The consumer stopped early: drop work that has not started
+            for future in in_flight.handles():
+                future.cancel()
+            if self.executor == None:
+                # A stopped run does not wait for the calls it abandoned
+                executor.shutdown(wait=self.stop_reason() == None, cancel_futures=True)
+            if self.hedge_pool != None:
+                # Losing calls still running are left to finish on their own
+                self.hedge_pool.shutdown(wait=False, cancel_futures=True)
+                self.hedge_pool = None
+
+    def _remaining(self):
+        return None if self.cancel == None else self.cancel.remaining()
+
+    def _expired(self):
+        return self.cancel != None and self.cancel.expired()
+
+    # Runs one prompt for the given voter indices, serving what it can from the cache
+    def run_task(self, prompt, voters, **kwargs):
+        cached = self._cache_lookup(prompt, voters, kwargs)
+        missing = [voter for voter in voters if voter not in cached]
+        if len(missing) == 0:
+            return [cached[voter] for voter in voters]
+        kwargs["response_count"] = len(missing)
+        res, substituted = self.run_hedged(prompt, **kwargs)
+        return self._cache_store(prompt, voters, cached, missing, res, kwargs, store=not substituted)
+
+    def _cache_lookup(self, prompt, voters, kwargs):
+        # Responses already journaled by an interrupted run come first
+        found = {}
+        if self.journal != None:
+            found = self.journal.get_many(self.cache_namespace, prompt, voters, kwargs)
+        if self.cache != None and len(found) < len(voters):
+            remaining = [voter for voter in voters if voter not in found]
+            found.update(self.cache.get_many(self.cache_namespace, prompt, remaining, kwargs))
+        return found
+
+    def _cache_store(self, prompt, voters, cached, missing, res, kwargs, store=True):
+        # Answers from a fallback pipe or model are not stored under this key
+        if isinstance(res, FailedRequest):
+            return res
+        fresh = dict(zip(missing, res))
+        if self.journal != None and store:
+            self.journal.put_many(self.cache_namespace, prompt, fresh, kwargs)
+        if self.cache != None and store:
+            self.cache.put_many(self.cache_namespace, prompt, fresh, kwargs)
+        if len(cached) == 0:
+            return res
+        merged = [cached[voter] if voter in cached else fresh.get(voter) for voter in voters]
+        return [response for response in merged if response != None]
+
+    # Returns (result, whether it came from a different pipe or model)
+    def run_hedged(self, prompt, **kwargs):
+        backup = self._backup(kwargs)
+        delay = None if backup == None else self.hedge.delay()
+        start = time.monotonic()
+        if delay == None:
+            res = self.run_with_retries(prompt, **kwargs)
+            if self.hedge != None and not isinstance(res, FailedRequest):
+                self.hedge.record(time.monotonic() - start)
+            return res, False
+        primary_cancel = CancelToken(parent=self.cancel)
+        primary = self.hedge_pool.submit(self.run_with_retries, prompt, cancel=primary_cancel, **kwargs)
+        primary.add_done_callback(lambda future: self._record_latency(future, start))
+        done, _ = wait([primary], timeout=delay)
+        if len(done) > 0 or not self.hedge.allow():
+            return primary.result(), False
+        fallback, fallback_kwargs, substituted = backup
+        backup_cancel = CancelToken(parent=self.cancel)
+        second = self.hedge_pool.submit(fallback.run_with_retries, prompt, cancel=backup_cancel, **fallback_kwargs)
+        cancels = {primary: primary_cancel, second: backup_cancel}
+        pending = set(cancels)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                res = future.result()
+                if isinstance(res, FailedRequest):
+                    continue
+                # First answer wins; the other call stops at its next attempt
+                for other in pending:
+                    cancels[other].cancel()
+                    other.cancel()
+                if future is second:
+                    self.hedge.record_win()
+                    return res, substituted
+                return res, False
+        return primary.result(), False
+
+    def _backup(self, kwargs):
+        if self.hedge == None:
+            return None
+        fallback = self.fallback if self.fallback != None else self
+        if fallback.fan_out and (kwargs.get("response_count") or 1) > 1:
+            return None
+        fallback_kwargs = dict(kwargs, **self.fallback_kwargs)
+        # A None override removes a parameter the fallback pipe does not take
+        for key, value in self.fallback_kwargs.items():
+            if value == None:
+                fallback_kwargs.pop(key)
+        return fallback, fallback_kwargs, fallback is not self or fallback_kwargs != kwargs
+
+    def _record_latency(self, handle, start):
+        # A call cancelled after losing took at least this long
+        if handle.cancelled():
+            self.hedge.record(time.monotonic() - start)
+        elif handle.exception() == None and not isinstance(handle.result(), FailedRequest):
+            self.hedge.record(time.monotonic() - start)
+
+    def run_with_retries(self, prompt, cancel=None, **kwargs):
+        cancel = cancel if cancel != None else self.cancel
+        state = _RetryState()
+        while True:
+            if _stop_reason(cancel) != None:
+                return self._record_failure(FailedRequest(_stop_reason(cancel), state.error, state.attempts))
+            if not self._circuit_allows():
+                backoff, failure = self._after_circuit_open(state)
+            else:
+                kind = None
+                slot = False
+                entered = False
+                started = None
+                queued = time.monotonic()
+                try:
+                    # The provider budget is queued for first so that its
+                    # priority order is not bypassed by the rate limiter
+                    if self.budget != None:
+                        if not self.budget.acquire(self.run_id, self.priority, cancel):
+                            # Stopped while queued: the check above returns
+                            continue
+                        slot = True
+                    if self.rate_limiter != None:
+                        self.rate_limiter.acquire(*request_cost(prompt, self.max_choices, **kwargs))
+                        entered = True
+                    started = self._record_start(queued)
+                    output = self.function(prompt, **kwargs)
+                    started = self._record_end(started)
+                    self._after_success()
+                    time.sleep(self.delay)
                     return output
+                except Exception as e:
+                    kind = classify(e)
+                    started = self._record_end(started, kind)
+                    backoff, failure = self._after_error(e, kind, state)
+                finally:
+                    # A call interrupted by a BaseException (KeyboardInterrupt)
+                    self._record_end(started, "cancelled")
+                    if entered:
+                        self.rate_limiter.release(kind == RATE_LIMIT)
+                    if slot:
+                        self.budget.release(self.run_id)
+            if failure != None:
+                return self._record_failure(failure)
+            if self.metrics != None:
+                self.metrics.record_retry()
+            if cancel != None:
+                cancel.wait(backoff)
+            else:
+                time.sleep(backoff)
+
+    # Returns the start time of the call
+    def _record_start(self, queued):
+        started = time.monotonic()
+        if self.metrics != None:
+            self.metrics.record_start(started - queued)
+        return started
+
+    # started is None when there is no call to record: it never started (the
+    # budget or the limiter failed) or was already recorded. Returns None.
+    def _record_end(self, started, kind=None):
+        if self.metrics != None and started != None:
+            self.metrics.record_end(time.monotonic() - started, kind)
+        return None
+
+    def _record_failure(self, failure):
+        if self.metrics != None:
+            self.metrics.record_failure(failure.reason)
+        return failure
+
+    def _circuit_allows(self):
+        return self.circuit_breaker == None or self.circuit_breaker.allow()
+
+    def _after_success(self):
+        if self.circuit_breaker != None:
+            self.circuit_breaker.record_success()
+
+    # Both return (seconds to wait before the next attempt, FailedRequest or None)
+    def _after_error(self, e, kind, state):
+        state.attempts += 1
+        state.error = e
+        if kind == FATAL or kind == RATE_LIMIT:
+            # The provider answered (rejecting or throttling): it is not down
+            self._after_success()
+        else:
+            state.failures += 1
+            if self.circuit_breaker != None:
+                self.circuit_breaker.record_failure()
+        if kind == FATAL:
+            return 0, FailedRequest(REASON_FATAL, e, state.attempts)
+        if kind == RATE_LIMIT:
+            state.rate_limits += 1
+        if not self.retry_policy.should_retry(kind, state.failures, state.rate_limits):
+            return 0, FailedRequest(REASON_EXHAUSTED, e, state.attempts)
+        return self.retry_policy.delay(state.attempts - 1, e), None
 
-    def run_with_retries(self, prompt, **kwargs):
-        try_cnt = 0
-        while try_cnt < self.max_retries:
-            try:
-                output = self.function(prompt, **kwargs)
-                time.sleep(self.delay)
-                return output
-            except Exception as e:
-                time.sleep(self.delay)
-                # if api error is not due to rate limit, try again
-                if "rate limit" not in str(e).lower() and "429" not in str(e):
-                    try_cnt += 1
-        return ""
\ No newline at end of file
+    def _after_circuit_open(self, state):
+        # Counts as a failed attempt without sending anything
+        state.failures += 1
+        if state.failures >= self.retry_policy.max_retries:
+            return 0, FailedRequest(REASON_CIRCUIT_OPEN, state.error, state.attempts)
+        return max(self.circuit_breaker.remaining(), self.retry_policy.backoff(state.failures)), None
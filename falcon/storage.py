@@ -1,6 +1,6 @@
 from typing import List
 from datetime import datetime
-from datasets import load_dataset, Dataset
+from .retry import FailedRequest
 
 _RESERVED_ID_COLUMN = "__id"
 
@@ -12,14 +12,21 @@ _EXPERIMENT_DS_SUFFIX = "_experiments"
 _EXPERIMENT_KEYS = [_RESERVED_ID_COLUMN, "name", "description", "model"]
 
 _RESULTS_DS_SUFFIX = "_results"
-_RESULTS_KEYS = [_RESERVED_ID_COLUMN, "experiment_id", "problem_id", "prompt", "model_solution", "date"]
+_RESULTS_KEYS = [_RESERVED_ID_COLUMN, "experiment_id", "problem_id", "prompt", "model_solution", "date", "failure"]
+# Results columns added after the first release, filled with this value in
+# projects saved before them
+_RESULTS_OPTIONAL_KEYS = {"failure": None}
+
+_GRADES_DS_SUFFIX = "_grades"
+_GRADES_KEYS = ["result_id", "grader_version", "answer", "correct"]
 
 class Storage:
     def __init__(
         self,
         statements,
         experiments,
-        results
+        results,
+        grades=None
     ):
         # Validate keys in statements
         for key in _STATEMENT_KEYS:
@@ -38,6 +45,9 @@ class Storage:
                 raise Exception(f"Invalid key {key} in experiments.")
 
         # Validate keys in results
+        for key, value in _RESULTS_OPTIONAL_KEYS.items():
+            if key not in results and _RESERVED_ID_COLUMN in results:
+                results[key] = [value for _ in results[_RESERVED_ID_COLUMN]]
         for key in _RESULTS_KEYS:
             if key not in results:
                 raise Exception(f"There must be a {key} key in results.")
@@ -45,6 +55,16 @@ class Storage:
             if key not in _RESULTS_KEYS:
                 raise Exception(f"Invalid key {key} in results.")
 
+        # Validate keys in grades (optional: projects saved before grading have none)
+        if grades == None:
+            grades = {key: [] for key in _GRADES_KEYS}
+        for key in _GRADES_KEYS:
+            if key not in grades:
+                raise Exception(f"There must be a {key} key in grades.")
+        for key in grades:
+            if key not in _GRADES_KEYS:
+                raise Exception(f"Invalid key {key} in grades.")
+
         # Retrieve table lengths
         self.__statements_count = len(statements[_RESERVED_ID_COLUMN])
         self.__experiments_count = len(experiments[_RESERVED_ID_COLUMN])
@@ -63,10 +83,22 @@ class Storage:
             if len(results[key]) != self.__results_count:
                 raise Exception(f"Dismatch in column length of results (check {key})")
 
+        for key in _GRADES_KEYS:
+            if len(grades[key]) != len(grades["result_id"]):
+                raise Exception(f"Dismatch in column length of grades (check {key})")
+
         # Write local variables
         self.__statements = statements
         self.__experiments = experiments
         self.__results = results
+        self.__grades = grades
+
+        # Row of each statement id and of each (result id, grader version) grade
+        self.__statement_rows = {_id: row for row, _id in enumerate(statements[_RESERVED_ID_COLUMN])}
+        self.__grade_rows = {(rid, version): row for row, (rid, version) in enumerate(zip(grades["result_id"], grades["grader_version"]))}
+        # (experiment id, grader version) -> results rows scanned so far and
+        # [correct, graded] per problem id
+        self.__grading = {}
 
     @staticmethod
     def create(
@@ -111,6 +143,8 @@ class Storage:
         ids = list(range(self.__statements_count, self.__statements_count + count))
 
         # Add problems
+        for row, _id in enumerate(ids, start=len(self.__statements[_RESERVED_ID_COLUMN])):
+            self.__statement_rows[_id] = row
         for key in _STATEMENT_KEYS:
             if key == _RESERVED_ID_COLUMN:
                 self.__statements[_RESERVED_ID_COLUMN] += ids
@@ -164,10 +198,15 @@ class Storage:
             index = self.__statements[_RESERVED_ID_COLUMN].index(_id)
             return {key: self.__statements[key][index] for key in _STATEMENT_KEYS}
 
+    # model_solutions is one entry per statement, as returned by
+    # Challenger.solve_problems: a solution, a list of solutions or a
+    # FailedRequest, and the lists may hold FailedRequests as well. A failed
+    # request is kept as a result with no model_solution and its reason in
+    # the failure column.
     def add_results(
         self,
         experiment : str,
-        model_solutions : List[List[str] | str],
+        model_solutions : List[List[str | FailedRequest] | str | FailedRequest],
         *,
         prompts : List[str] | None = None,
         statements : List[str] | None = None
@@ -208,12 +247,19 @@ class Storage:
         aug_problem_ids = []
         aug_prompts = []
         aug_model_solutions = []
+        aug_failures = []
         total_count = 0
 
         for i, entry in enumerate(model_solutions):
-            if isinstance(entry, str):
+            if isinstance(entry, (str, FailedRequest)):
                 entry = [entry]
-            aug_model_solutions += entry
+            for solution in entry:
+                if isinstance(solution, FailedRequest):
+                    aug_model_solutions.append(None)
+                    aug_failures.append(solution.reason)
+                else:
+                    aug_model_solutions.append(solution)
+                    aug_failures.append(None)
             local_count = len(entry)
             aug_problem_ids += [statement_ids[i] for _ in range(local_count)]
             aug_prompts += [prompts[i] for _ in range(local_count)]
@@ -231,6 +277,7 @@ class Storage:
         self.__results["prompt"] += aug_prompts
         self.__results["model_solution"] += aug_model_solutions
         self.__results["date"] += aug_dates
+        self.__results["failure"] += aug_failures
 
         # Increment count
         self.__results_count += total_count
@@ -269,7 +316,7 @@ class Storage:
         # Initialize problems temp dictionary
         problems_temp = {}
 
-        # _RESULTS_KEYS = [_RESERVED_ID_COLUMN, "experiment_id", "problem_id", "prompt", "model_solution", "date"]
+        # _RESULTS_KEYS = [_RESERVED_ID_COLUMN, "experiment_id", "problem_id", "prompt", "model_solution", "date", "failure"]
 
         # Add problems and generations
         for i, entry_eid in enumerate(self.__results["experiment_id"]):
@@ -284,7 +331,8 @@ class Storage:
                 problems_temp[prob_id]["generations"].append({
                     "user": self.__results["prompt"][i],
                     "assistant": self.__results["model_solution"][i],
-                    "date": self.__results["date"][i]
+                    "date": self.__results["date"][i],
+                    "failure": self.__results["failure"][i]
                 })
         
         # Convert the dictionary to list
@@ -310,13 +358,92 @@ class Storage:
             statements[i] = problem['statement']
             answers[i] = problem['answer']
             for gen in problem['generations']:
-                results[i].append(gen['assistant'])
+                # Failed requests come back as they were given to add_results
+                if gen['failure'] != None:
+                    results[i].append(FailedRequest(gen['failure']))
+                else:
+                    results[i].append(gen['assistant'])
         return statements,answers,results
 
+    # Fraction of correct results per problem of the experiment, in the order
+    # of get_experiment_lists (as Grader.grade_solutions would give for it,
+    # None for a problem whose requests all failed).
+    # The grade of every result is kept, keyed by its __id and the grader
+    # version (GRADER_VERSION, with "+symbolic" for symbolic=True), and saved
+    # by push_to_hub; each call only extracts and grades the results added
+    # since the previous one.
+    def grade_experiment(
+        self,
+        name : str,
+        *,
+        symbolic : bool = False,
+        workers : int | None = None
+    ) -> List[float]:
+        from .answers import extract_answer
+        from .equivalence import equivalent_answers
+        from .grader import GRADER_VERSION
+
+        experiment = self.__get_experiment_by_name(name)
+        if experiment == None:
+            raise Exception(f"Invalid experiment name: {name}.")
+        eid = experiment[_RESERVED_ID_COLUMN]
+        version = str(GRADER_VERSION) + ("+symbolic" if symbolic else "")
+        state = self.__grading.setdefault((eid, version), {"scanned": 0, "problems": {}})
+
+        # Count the new results already graded (loaded with the project) and
+        # extract the answers of the others, by problem
+        pending = {}
+        for i in range(state["scanned"], self.__results_count):
+            if self.__results["experiment_id"][i] != eid:
+                continue
+            rid = self.__results[_RESERVED_ID_COLUMN][i]
+            pid = self.__results["problem_id"][i]
+            counts = state["problems"].setdefault(pid, [0, 0])
+            row = self.__grade_rows.get((rid, version))
+            if self.__results["failure"][i] != None:
+                # Failed requests are not graded, as in Grader
+                continue
+            if row != None:
+                counts[0] += int(bool(self.__grades["correct"][row]))
+                counts[1] += 1
+            else:
+                pending.setdefault(pid, []).append((rid, extract_answer(self.__results["model_solution"][i])))
+        state["scanned"] = self.__results_count
+
+        # Grade them, one problem at a time
+        pids = list(pending)
+        problems = []
+        for pid in pids:
+            truth = self.__statements["answer"][self.__statement_rows[pid]]
+            problems.append((None if truth == None else str(truth), [answer for _, answer in pending[pid]]))
+        matches = equivalent_answers(problems, symbolic=symbolic, workers=workers)
+        for pid, correct in zip(pids, matches):
+            counts = state["problems"][pid]
+            for rid, answer in pending[pid]:
+                self.__add_grade(rid, version, answer, answer in correct)
+                counts[0] += int(answer in correct)
+                counts[1] += 1
+
+        return [None if graded == 0 else correct / graded for correct, graded in state["problems"].values()]
+
+    def __add_grade(
+        self,
+        rid : int,
+        version : str,
+        answer : str | None,
+        correct : bool
+    ) -> None:
+        self.__grade_rows[(rid, version)] = len(self.__grades["result_id"])
+        self.__grades["result_id"].append(rid)
+        self.__grades["grader_version"].append(version)
+        self.__grades["answer"].append(answer)
+        self.__grades["correct"].append(correct)
+
     def dev_print(self):
         print(self.__statements, "\n")
         print(self.__experiments, "\n")
         print(self.__results, "\n")
+        print(self.__grades, "\n")
 
     @staticmethod
     def load_project(
@@ -324,10 +451,17 @@ class Storage:
         *,
         token : str | None = None
     ):
+        # datasets (and pyarrow/pandas) is only imported when needed
+        from datasets import load_dataset
         statements = load_dataset(path + _STATEMENT_DS_SUFFIX, token=token)['train'].to_dict()
         experiments = load_dataset(path + _EXPERIMENT_DS_SUFFIX, token=token)['train'].to_dict()
         results = load_dataset(path + _RESULTS_DS_SUFFIX, token=token)['train'].to_dict()
-        return Storage(statements, experiments, results)
+        # Projects pushed before any grading have no grades dataset
+        try:
+            grades = load_dataset(path + _GRADES_DS_SUFFIX, token=token)['train'].to_dict()
+        except FileNotFoundError:
+            grades = None
+        return Storage(statements, experiments, results, grades)
 
     def push_to_hub(
         self,
@@ -335,9 +469,12 @@ class Storage:
         *,
         token : str | None = None
     ):
+        from datasets import Dataset
         ds_statements = Dataset.from_dict(self.__statements)
         ds_experiments = Dataset.from_dict(self.__experiments)
         ds_results = Dataset.from_dict(self.__results)
         ds_statements.push_to_hub(path + _STATEMENT_DS_SUFFIX, token=token)
         ds_experiments.push_to_hub(path + _EXPERIMENT_DS_SUFFIX, token=token)
-        ds_results.push_to_hub(path + _RESULTS_DS_SUFFIX, token=token)
\ No newline at end of file
+        ds_results.push_to_hub(path + _RESULTS_DS_SUFFIX, token=token)
+        if len(self.__grades["result_id"]) > 0:
+            Dataset.from_dict(self.__grades).push_to_hub(path + _GRADES_DS_SUFFIX, token=token)
\ No newline at end of file
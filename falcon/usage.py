@@ -0,0 +1,75 @@
+import threading
+
+_USAGE = {}
+_USAGE_LOCK = threading.Lock()
+# (pipe, batch id) of the batches whose usage was recorded
+_BATCHES = set()
+
+
+def _field(obj, name):
+    # Usage arrives as an SDK object (sync responses) or a dict (batch output)
+    if obj == None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+# Prompt tokens the provider served from its prefix cache. OpenAI reports
+# them in usage.prompt_tokens_details.cached_tokens, some OpenAI-compatible
+# providers in usage.cached_tokens.
+def cached_tokens(usage):
+    cached = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached == None:
+        cached = _field(usage, "cached_tokens")
+    return cached or 0
+
+
+# Called by the pipes with the usage block of every response they receive
+# and the finish_reason of its choices ("stop", "length", ...)
+def record_usage(pipename, model, usage, finish_reasons=None):
+    if usage == None and finish_reasons == None:
+        return
+    with _USAGE_LOCK:
+        totals = _USAGE.setdefault((pipename, model), {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "finish_reasons": {}})
+        totals["requests"] += 1
+        if usage != None:
+            totals["prompt_tokens"] += _field(usage, "prompt_tokens") or 0
+            totals["cached_tokens"] += cached_tokens(usage)
+            totals["completion_tokens"] += _field(usage, "completion_tokens") or 0
+        for reason in finish_reasons or []:
+            totals["finish_reasons"][reason] = totals["finish_reasons"].get(reason, 0) + 1
+
+
+# Batch output may be retrieved any number of times (polling, JobManager,
+# a direct call): the pipes record its usage only when this returns True,
+# the first time it is called for the batch
+def claim_batch_usage(pipename, batch_id):
+    with _USAGE_LOCK:
+        if (pipename, batch_id) in _BATCHES:
+            return False
+        _BATCHES.add((pipename, batch_id))
+        return True
+
+
+# Token usage summed over the responses received by this process, for one
+# pipe (and model) or all of them. cache_hit_rate is the share of prompt
+# tokens that were served from the provider's prefix cache.
+def get_usage(pipename=None, model=None):
+    stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    finish_reasons = {}
+    with _USAGE_LOCK:
+        for (pipe, pipe_model), totals in _USAGE.items():
+            if (pipename == None or pipe == pipename) and (model == None or pipe_model == model):
+                for name in stats:
+                    stats[name] += totals[name]
+                for reason, count in totals["finish_reasons"].items():
+                    finish_reasons[reason] = finish_reasons.get(reason, 0) + count
+    stats["finish_reasons"] = finish_reasons
+    stats["cache_hit_rate"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] > 0 else None
+    return stats
+
+
+def reset_usage():
+    with _USAGE_LOCK:
+        _USAGE.clear()
@@ -0,0 +1,20 @@
+from falcon.answers import extract_answer, extract_answers
+
+
+def test_extract_answer_skips_empty_boxes():
+    assert extract_answer("a \\boxed{5} then \\boxed{}") == "5"
+    assert extract_answer("\\boxed{}") == None
+
+
+def test_extract_answer_balances_braces():
+    assert extract_answer("so $\\boxed{\\frac{1}{2}}$.") == "\\frac{1}{2}"
+    assert extract_answer("\\boxed{\\frac{\\sqrt{x^{2}}}{2}}") == "\\frac{\\sqrt{x^{2}}}{2}"
+    assert extract_answer("\\boxed{\\{1, 2\\}}") == "\\{1, 2\\}"
+
+
+def test_extract_answer_falls_back():
+    assert extract_answer("\\boxed{3} and \\fbox{4}") == "4"
+    assert extract_answer("\\boxed{3} and \\boxed{\\frac{1}{") == "3"
+    assert extract_answer("\\boxed {7}") == "7"
+    assert extract_answer("Final Answer: 12.") == "12"
+    assert extract_answers(["cut sho", None]) == [None, None]
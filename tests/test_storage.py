@@ -0,0 +1,28 @@
+from falcon.retry import FailedRequest, REASON_EXHAUSTED, REASON_DEADLINE
+from falcon.storage import Storage
+
+
+def _storage():
+    storage = Storage.create("test")
+    storage.add_problems(["1+1", "2+2"], answer=["2", "4"])
+    storage.create_experiment("run")
+    return storage
+
+
+def test_add_results_keeps_failed_requests():
+    storage = _storage()
+    storage.add_results("run", [["\\boxed{2}", FailedRequest(REASON_EXHAUSTED)], FailedRequest(REASON_DEADLINE)])
+
+    _, _, results = storage.get_experiment_lists("run")
+    assert results[0][0] == "\\boxed{2}"
+    assert isinstance(results[0][1], FailedRequest) and results[0][1].reason == REASON_EXHAUSTED
+    assert len(results[1]) == 1 and results[1][0].reason == REASON_DEADLINE
+
+    generations = storage.get_experiment("run")["problems"][1]["generations"]
+    assert generations[0]["assistant"] == None and generations[0]["failure"] == REASON_DEADLINE
+
+
+def test_grade_experiment_skips_failed_requests():
+    storage = _storage()
+    storage.add_results("run", [["\\boxed{2}", FailedRequest(REASON_EXHAUSTED)], FailedRequest(REASON_DEADLINE)])
+    assert storage.grade_experiment("run", workers=0) == [1.0, None]